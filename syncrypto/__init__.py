@@ -16,8 +16,8 @@
 #    limitations under the License.
 
 from .filetree import FileEntry, FileTree, FileRule, FileRuleSet, \
-    InvalidRegularExpression
+    InvalidRegularExpression, TreeChange
 from .crypto import Crypto
-from .core import Syncrypto, InvalidFolder
+from .core import Syncrypto, SyncPlan, InvalidFolder, SyncInterrupted
 from .core import main as cli
 from .package_info import __version__, __author__, __doc__
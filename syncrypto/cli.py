@@ -18,7 +18,8 @@
 from __future__ import unicode_literals
 import argparse
 from .package_info import __doc__ as description
-from .util import command_text
+from .util import command_text, parse_size, positive_int, \
+    positive_size, DIGEST_ALGORITHMS
 
 
 parser = argparse.ArgumentParser(
@@ -58,6 +59,17 @@ parser.add_argument(
     help='Print the file tree in encrypted folder'
 )
 
+parser.add_argument(
+    '--stats',
+    type=command_text,
+    nargs='?',
+    const='',
+    metavar='PATHNAME',
+    help=('Print the number, total size and newest modification time of the '
+          'files under a path of the encrypted folder, default is the whole '
+          'folder')
+)
+
 parser.add_argument(
     '--decrypt-file',
     type=command_text,
@@ -98,6 +110,77 @@ parser.add_argument(
     help='Add include or exclude rules'
 )
 
+parser.add_argument(
+    '--fast-scan',
+    action="store_true",
+    help=('Do not list the plaintext folders whose modification time is not '
+          'changed since the last sync, only works with rules on names and '
+          'paths')
+)
+
+parser.add_argument(
+    '--fingerprint-size',
+    metavar='SIZE',
+    type=parse_size,
+    help=('Fingerprint the plaintext files larger than SIZE (like 100m) by '
+          'sampling blocks of them, so changes keeping the size and the '
+          'modification time are found')
+)
+
+parser.add_argument(
+    '--dry-run',
+    action="store_true",
+    help=('Print what a sync would do and the bytes it would read and '
+          'write, without changing anything')
+)
+
+parser.add_argument(
+    '-j', '--jobs',
+    metavar='N',
+    type=positive_int,
+    help=('Encrypt and decrypt N files at a time, also the number of files '
+          'hashed at a time by --verify-content (4 by default)')
+)
+
+parser.add_argument(
+    '--checkpoint-files',
+    metavar='N',
+    type=positive_int,
+    help=('Save the progress of a sync every N encrypted or decrypted '
+          'files, an interrupted sync resumes from the last checkpoint')
+)
+
+parser.add_argument(
+    '--checkpoint-size',
+    metavar='SIZE',
+    type=positive_size,
+    help=('Save the progress of a sync every SIZE bytes written, like '
+          '100M or 1G')
+)
+
+parser.add_argument(
+    '--digest-algorithm',
+    choices=DIGEST_ALGORITHMS,
+    default='md5',
+    help=('Algorithm of the content digests kept for the files, '
+          'default is md5')
+)
+
+parser.add_argument(
+    '--fan-out',
+    metavar='N',
+    type=positive_int,
+    help=('Put the new encrypted files of a folder with more than N files '
+          'into hashed sub folders, so no encrypted folder gets too large')
+)
+
+parser.add_argument(
+    '--verify-content',
+    action="store_true",
+    help=('Hash the plaintext files whose modification time changed but not '
+          'the size, they are encrypted only if the content changed')
+)
+
 parser.add_argument(
     '--debug',
     action="store_true",
@@ -23,15 +23,20 @@ import os
 import sys
 import os.path
 import shutil
-import json
+import signal
+import tempfile
 from datetime import datetime
 from time import sleep, time
 from lockfile.mkdirlockfile import MkdirLockFile as LockFile
 from random import randint
+from multiprocessing.pool import ThreadPool
+from collections import deque, namedtuple
 from stat import S_IWUSR, S_IRUSR
 from .crypto import Crypto, DecryptError
-from .filetree import FileTree, FileRuleSet, FileEntry
-from .util import printable_text, string_digest, getpass
+from .filetree import FileTree, FileRuleSet, FileEntry, FileTreeEncoder, \
+    FileTreeDecoder, FileTreeIndex, merge_sorted_items
+from .util import printable_text, string_digest, getpass, file_digest, \
+    digest_algorithm, replace_file, sync_paths, TMP_SUFFIX
 
 try:
     from cStringIO import StringIO as BytesIO
@@ -51,6 +56,10 @@ class InvalidFolder(Exception):
     pass
 
 
+class SyncInterrupted(Exception):
+    pass
+
+
 DEFAULT_RULES = b"""ignore: name eq .Trashes
 ignore: name eq .fseventsd
 ignore: name eq Thumb.db
@@ -71,9 +80,19 @@ ignore: name match *.swo"""
 
 class Syncrypto(object):
 
+    # number of threads hashing plaintext files in verify content mode
+    HASH_JOBS = 4
+
+    # hex digits of the name digest naming a bucket folder in fan out mode
+    BUCKET_WIDTH = 2
+
     def __init__(self, crypto, encrypted_folder, plain_folder=None,
                  encrypted_tree=None, plain_tree=None, snapshot_tree=None,
-                 rule_set=None, rule_file=None, debug=False):
+                 rule_set=None, rule_file=None, debug=False,
+                 fast_scan=False, verify_content=False,
+                 fingerprint_size=None, fan_out=None,
+                 digest_algorithm='md5', jobs=None,
+                 checkpoint_files=None, checkpoint_size=None):
 
         self.crypto = crypto
         self.encrypted_folder = encrypted_folder
@@ -83,9 +102,36 @@ class Syncrypto(object):
         self.snapshot_tree = snapshot_tree
         self.rule_set = rule_set
         self._debug = debug
+        self._fast_scan = fast_scan
+        self._verify_content = verify_content
+        self._fingerprint_size = fingerprint_size
+        if fan_out is not None and fan_out < 1:
+            raise ValueError("fan_out must be at least 1")
+        self._fan_out = fan_out
+        self._digest_algorithm = digest_algorithm
+        if jobs is not None and jobs < 1:
+            raise ValueError("jobs must be at least 1")
+        self._jobs = jobs
+        if checkpoint_files is not None and checkpoint_files < 1:
+            raise ValueError("checkpoint_files must be at least 1")
+        if checkpoint_size is not None and checkpoint_size < 1:
+            raise ValueError("checkpoint_size must be at least 1")
+        self._checkpoint_files = checkpoint_files
+        self._checkpoint_size = checkpoint_size
+        self._checkpointed = False
+        self._interrupted = None
         self._encrypted_folder_is_new = False
         self._trash_name = self._generate_trash_name()
         self._snapshot_trash_name = None
+        self._snapshot_rules = None
+        # plaintext folders the sync writes into
+        self._written_dirnames = set()
+        # {pathname: mtime} of this plaintext folder which only the snapshot
+        # tree keeps, for files the same as their encrypted entry with another
+        # mtime and for folders in fast scan mode
+        self._plain_mtimes = {}
+        # files written by the sync, made durable before the trees are saved
+        self._written_paths = []
         self._snapshot_tree_name = string_digest(self.encrypted_folder)
         self._encrypted_filetree_entry = None
 
@@ -148,33 +194,54 @@ class Syncrypto(object):
     def _generate_trash_name():
         return datetime.now().isoformat().replace(':', '_')
 
+    def _bucket_path(self, dirname, digest):
+        """Bucket folders holding a new entry of the folder dirname, one more
+        level for every fan_out * 16 ** BUCKET_WIDTH entries it already has.
+        Buckets are named by the end of the digest, the entry by its start,
+        and bucket names start with '_' so they never clash with entries."""
+        path = ''
+        if self._fan_out is None:
+            return path
+        count = self.encrypted_tree.count_names(dirname)
+        limit = self._fan_out
+        end = len(digest)
+        while count >= limit and end > self.BUCKET_WIDTH:
+            path += '_' + digest[end-self.BUCKET_WIDTH:end] + '/'
+            end -= self.BUCKET_WIDTH
+            limit *= 16 ** self.BUCKET_WIDTH
+        return path
+
     def _generate_encrypted_path(self, encrypted_file):
         dirname, name = encrypted_file.split()
         digest = string_digest(name)
+        bucket_path = self._bucket_path(dirname, digest)
         i = 2
         while True:
             if dirname == '':
-                fs_pathname = digest[:i]
+                fs_pathname = bucket_path + digest[:i]
             else:
                 parent = self.encrypted_tree.get(dirname)
                 if parent is None:
                     self.error("Can not find file entry for %s" %
                                dirname)
                     raise GenerateEncryptedFilePathError()
-                fs_pathname = parent.fs_pathname + '/' + digest[:i]
+                fs_pathname = parent.fs_pathname + '/' + bucket_path + \
+                    digest[:i]
             if not self.encrypted_tree.has_fs_pathname(fs_pathname):
                 encrypted_file.fs_pathname = fs_pathname
                 return
             i += 1
         raise GenerateEncryptedFilePathError()
 
-    def _encrypt_file(self, pathname):
+    def _encrypt_file(self, pathname, queue):
+        """Encrypt pathname, folders right away and files as a job of queue,
+        the encrypted tree is updated when the job is finished"""
         plain_file = self.plain_tree.get(pathname)
         plain_path = plain_file.fs_path(self.plain_folder)
         encrypted_file = self.encrypted_tree.get(pathname)
         if not os.path.exists(plain_path):
             self.error("%s not exists!" % plain_path)
-            return encrypted_file
+            return
         if encrypted_file is None:
             encrypted_file = plain_file.clone()
             if pathname.startswith(".syncrypto/"):
@@ -183,42 +250,73 @@ class Syncrypto(object):
                 try:
                     self._generate_encrypted_path(encrypted_file)
                 except GenerateEncryptedFilePathError:
-                    return None
+                    return
         encrypted_path = encrypted_file.fs_path(self.encrypted_folder)
-        mtime = plain_file.mtime
         if plain_file.isdir:
             if not os.path.exists(encrypted_path):
                 os.makedirs(encrypted_path)
             encrypted_file.copy_attr_from(plain_file)
-            return encrypted_file
+            self.encrypted_tree.set(pathname, encrypted_file)
+            return
+        # the entry holds its fs_pathname while the file is encrypted
+        self.encrypted_tree.set(pathname, encrypted_file)
+
+        def finish(encrypted_plain_file):
+            encrypted_file.copy_attr_from(encrypted_plain_file)
+            self.encrypted_tree.set(pathname, encrypted_file)
+            self._written_paths.append(encrypted_path)
+            self.info("Encrypt %s to %s" %
+                      (plain_file.fs_pathname, encrypted_file.fs_pathname))
+
+        queue.add(self._encrypt_content,
+                  (plain_file.clone(), plain_path, encrypted_file,
+                   encrypted_path), finish)
+
+    def _encrypt_content(self, plain_file, plain_path, encrypted_file,
+                         encrypted_path):
+        """Encrypt the file at plain_path to encrypted_path, return
+        plain_file with the digest and salt of the encryption"""
+        mtime = plain_file.mtime
+        # not next to the encrypted files, in a folder of this client
+        # only, what a crash leaves is removed by its next sync
+        fd, tmp_path = tempfile.mkstemp(suffix=TMP_SUFFIX,
+                                        dir=self._encrypted_tmp_folder())
+        self._ensure_dir(encrypted_path)
+        encrypted_fd = os.fdopen(fd, 'wb')
+        try:
+            plain_fd = open(plain_path, 'rb')
+            try:
+                self.crypto.encrypt_fd(plain_fd, encrypted_fd, plain_file,
+                                       digest_algorithm=self._digest_algorithm)
+            finally:
+                plain_fd.close()
+                encrypted_fd.close()
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        if plain_file.mode is not None:
+            os.chmod(tmp_path, plain_file.mode)
+        os.utime(tmp_path, (mtime, mtime))
         if os.path.exists(encrypted_path):
             self._move_to_encrypted_trash(encrypted_file)
-        directory = os.path.dirname(encrypted_path)
-        if not os.path.isdir(directory):
-            os.makedirs(directory)
-        plain_fd = open(plain_path, 'rb')
-        encrypted_fd = open(encrypted_path, 'wb')
-        self.crypto.encrypt_fd(plain_fd, encrypted_fd, plain_file)
-        encrypted_file.copy_attr_from(plain_file)
-        if plain_file.mode is not None:
-            os.chmod(encrypted_path, plain_file.mode)
-        os.utime(encrypted_path, (mtime, mtime))
-        plain_fd.close()
-        encrypted_fd.close()
-        return encrypted_file
+        replace_file(tmp_path, encrypted_path)
+        return plain_file
 
-    def _decrypt_file(self, pathname):
+    def _decrypt_file(self, pathname, queue):
+        """Decrypt pathname, folders right away and files as a job of queue,
+        the plaintext tree is updated when the job is finished"""
         encrypted_file = self.encrypted_tree.get(pathname)
         encrypted_path = encrypted_file.fs_path(self.encrypted_folder)
         plain_file = self.plain_tree.get(pathname)
         if not os.path.exists(encrypted_path):
             self.error("%s not exists!" % encrypted_path)
-            return plain_file
+            return
         if plain_file is None:
             plain_file = encrypted_file.clone()
             plain_file.fs_pathname = plain_file.pathname
         plain_path = plain_file.fs_path(self.plain_folder)
         mtime = encrypted_file.mtime
+        self._written_dirnames.add(pathname.rpartition('/')[0])
         if encrypted_file.isdir:
             if not os.path.exists(plain_path):
                 os.makedirs(plain_path)
@@ -226,22 +324,47 @@ class Syncrypto(object):
                 os.chmod(plain_path, encrypted_file.mode | S_IWUSR | S_IRUSR)
             os.utime(plain_path, (mtime, mtime))
             plain_file.copy_attr_from(encrypted_file)
-            return plain_file
+            plain_file.inode = os.stat(plain_path).st_ino or None
+            self.plain_tree.set(pathname, plain_file)
+            return
+
+        def finish(inode):
+            plain_file.copy_attr_from(encrypted_file)
+            plain_file.inode = inode
+            self.plain_tree.set(pathname, plain_file)
+            self._written_paths.append(plain_path)
+            self.info("Decrypt %s to %s" %
+                      (encrypted_file.fs_pathname, plain_file.fs_pathname))
+
+        queue.add(self._decrypt_content,
+                  (plain_file, plain_path, encrypted_file, encrypted_path),
+                  finish)
+
+    def _decrypt_content(self, plain_file, plain_path, encrypted_file,
+                         encrypted_path):
+        """Decrypt the file at encrypted_path to plain_path, return the inode
+        of the plaintext file"""
+        mtime = encrypted_file.mtime
+        tmp_path = plain_path + TMP_SUFFIX
+        self._ensure_dir(plain_path)
+        plain_fd = open(tmp_path, 'wb')
+        try:
+            encrypted_fd = open(encrypted_path, 'rb')
+            try:
+                self.crypto.decrypt_fd(encrypted_fd, plain_fd)
+            finally:
+                encrypted_fd.close()
+                plain_fd.close()
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        if encrypted_file.mode is not None:
+            os.chmod(tmp_path, encrypted_file.mode)
+        os.utime(tmp_path, (mtime, mtime))
         if os.path.exists(plain_path):
             self._move_to_plain_trash(plain_file)
-        directory = os.path.dirname(plain_path)
-        if not os.path.isdir(directory):
-            os.makedirs(directory)
-        plain_fd = open(plain_path, 'wb')
-        encrypted_fd = open(encrypted_path, 'rb')
-        self.crypto.decrypt_fd(encrypted_fd, plain_fd)
-        plain_file.copy_attr_from(encrypted_file)
-        plain_fd.close()
-        encrypted_fd.close()
-        if encrypted_file.mode is not None:
-            os.chmod(plain_path, encrypted_file.mode)
-        os.utime(plain_path, (mtime, mtime))
-        return plain_file
+        replace_file(tmp_path, plain_path)
+        return os.stat(plain_path).st_ino or None
 
     @staticmethod
     def _conflict_path(path):
@@ -264,6 +387,12 @@ class Syncrypto(object):
         return conflict_path
 
     def _is_ignore(self, plain_file, encrypted_file):
+        file_entry = plain_file or encrypted_file
+        if file_entry is None:
+            return self.rule_set.default_action != 'include'
+        action = self.rule_set.test_pathname(file_entry.pathname)
+        if action is not None:
+            return action != 'include'
         return (self.rule_set.test(plain_file) != 'include' or
                 self.rule_set.test(encrypted_file) != 'include')
 
@@ -271,14 +400,7 @@ class Syncrypto(object):
     def _is_equal(file_entry, file_entry_compare):
         if file_entry is None or file_entry_compare is None:
             return False
-        if file_entry.isdir and file_entry_compare.isdir:
-            return True
-        if file_entry.digest is not None \
-                and file_entry_compare.digest is not None:
-            return file_entry.digest == file_entry_compare.digest
-        return \
-            file_entry.size == file_entry_compare.size and \
-            int(file_entry.mtime) == int(file_entry_compare.mtime)
+        return file_entry.same_content(file_entry_compare)
 
     def _compare_file(self, encrypted_file, plain_file, snapshot_file):
         if self._is_ignore(plain_file, encrypted_file):
@@ -311,6 +433,75 @@ class Syncrypto(object):
                 return "remove encrypted"
         return None
 
+    def _verify_plain_digests(self):
+        """Hash the plaintext files which have the size of their encrypted
+        entry but not the mtime, and compare with the digest of the encrypted
+        entry. Files with the same content are not encrypted, the snapshot
+        tree keeps their plaintext mtime so they are not hashed again."""
+        candidates = []
+        encrypted_get = self.encrypted_tree.get
+        snapshot_get = self.snapshot_tree.get
+        for plain_file in self.plain_tree.iter_files():
+            if plain_file.digest is not None:
+                continue
+            encrypted_file = encrypted_get(plain_file.pathname)
+            if encrypted_file is None or encrypted_file.isdir or \
+                    digest_algorithm(encrypted_file.digest) is None or \
+                    encrypted_file.size != plain_file.size or \
+                    int(encrypted_file.mtime) == int(plain_file.mtime):
+                continue
+            # verified by an earlier sync, its digest still holds
+            snapshot_file = snapshot_get(plain_file.pathname)
+            if self._is_equal(plain_file, snapshot_file) and \
+                    self._is_equal(snapshot_file, encrypted_file):
+                plain_file.digest = encrypted_file.digest
+                self.plain_tree.set(plain_file.pathname, plain_file)
+                continue
+            # a different fingerprint already tells the content changed
+            if plain_file.fingerprint is not None and \
+                    encrypted_file.fingerprint is not None and \
+                    plain_file.fingerprint != encrypted_file.fingerprint:
+                continue
+            candidates.append((plain_file, encrypted_file))
+        if not candidates:
+            return
+        paths = [plain_file.fs_path(self.plain_folder)
+                 for plain_file, encrypted_file in candidates]
+        # hashed like the encrypted entry, which may be from another setting
+        algorithms = [digest_algorithm(encrypted_file.digest)
+                      for plain_file, encrypted_file in candidates]
+        pool = ThreadPool(self._jobs or self.HASH_JOBS)
+        try:
+            digests = pool.map(_try_file_digest, zip(paths, algorithms))
+        finally:
+            pool.close()
+            pool.join()
+        for (plain_file, encrypted_file), path, digest in \
+                zip(candidates, paths, digests):
+            if digest is None:
+                continue
+            plain_file.digest = digest
+            if digest == encrypted_file.digest:
+                self.debug("%s is touched but not changed" % path)
+            self.plain_tree.set(plain_file.pathname, plain_file)
+
+    def _is_unchanged(self, plain_file, encrypted_file):
+        """Whether a pathname is equal on both sides and not ignored, so it
+        needs no action whatever the snapshot tree says"""
+        return not self._encrypted_folder_is_new and \
+            self._is_equal(plain_file, encrypted_file) and \
+            not self._is_ignore(plain_file, encrypted_file)
+
+    @staticmethod
+    def _is_same_subtree(plain_file, encrypted_file):
+        """Whether everything under two directories is equal, judged by their
+        tree digests"""
+        if plain_file is None or encrypted_file is None:
+            return False
+        return plain_file.isdir and encrypted_file.isdir and \
+            plain_file.tree_digest is not None and \
+            plain_file.tree_digest == encrypted_file.tree_digest
+
     def _move_to_encrypted_trash(self, file_entry):
         trash_path = self._trash_path_in_encrypted_folder(file_entry)
         if os.path.exists(trash_path):
@@ -367,18 +558,45 @@ class Syncrypto(object):
         self._ensure_dir(path)
         return path
 
+    def _encrypted_tmp_path(self):
+        # the encrypted folder is shared, every client has its own
+        return os.path.join(self.encrypted_folder, "_syncrypto", "tmp",
+                            self._snapshot_tree_name)
+
+    def _encrypted_tmp_folder(self):
+        path = self._encrypted_tmp_path()
+        self._ensure_dir(os.path.join(path, TMP_SUFFIX))
+        return path
+
+    def _clear_encrypted_tmp_folder(self):
+        """Remove the files an interrupted sync of this client left
+        being encrypted"""
+        path = self._encrypted_tmp_path()
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
     def _save_trees(self):
+        # the trees must not refer to files which may be lost, the files
+        # written since the last save are flushed together
+        if self._written_paths:
+            sync_paths(self._written_paths)
+            self._written_paths = []
         self._save_encrypted_tree()
         self._save_snapshot_tree()
 
     def _save_encrypted_tree(self):
-        fp = open(self._encrypted_tree_path(), "wb")
-        tree_dict = self.encrypted_tree.to_dict()
-        tree_dict["snapshot_tree_name"] = self._snapshot_tree_name
-        self.crypto.encrypt_fd(BytesIO(json.dumps(tree_dict).encode("utf-8")),
-                               fp, self._encrypted_filetree_entry,
+        path = self._encrypted_tree_path()
+        fp = open(path + TMP_SUFFIX, "wb")
+        tree_fd = FileTreeEncoder(
+            self.encrypted_tree,
+            {"snapshot_tree_name": self._snapshot_tree_name,
+             "digest_algorithm": self._digest_algorithm})
+        self.crypto.encrypt_fd(tree_fd, fp, self._encrypted_filetree_entry,
                                Crypto.COMPRESS)
+        fp.flush()
+        os.fsync(fp.fileno())
         fp.close()
+        replace_file(path + TMP_SUFFIX, path)
 
     def _load_encrypted_tree(self):
         encrypted_tree_path = self._encrypted_tree_path()
@@ -392,54 +610,88 @@ class Syncrypto(object):
                 self._snapshot_tree_name = string_digest(
                     os.path.abspath(self.encrypted_folder)+str(time()))
         else:
+            self._encrypted_folder_is_new = False
             fp = open(encrypted_tree_path, "rb")
             try:
-                tree_fd = BytesIO()
+                tree_fd = FileTreeDecoder()
                 self._encrypted_filetree_entry = \
                     self.crypto.decrypt_fd(fp, tree_fd)
-                tree_fd.seek(0)
-                tree_dict = json.loads(tree_fd.getvalue().decode("utf-8"))
-                if "snapshot_tree_name" in tree_dict:
-                    self._snapshot_tree_name = tree_dict["snapshot_tree_name"]
-                self.encrypted_tree = FileTree.from_dict(tree_dict)
+                tree_fd.close()
+                if "snapshot_tree_name" in tree_fd.metadata:
+                    self._snapshot_tree_name = \
+                        tree_fd.metadata["snapshot_tree_name"]
+                self.encrypted_tree = tree_fd.tree
             finally:
                 fp.close()
 
     def _save_snapshot_tree(self):
-        fp = open(self._snapshot_tree_path(), 'wb')
-        snapshot_tree_dict = self.snapshot_tree.to_dict()
-        snapshot_tree_dict["trash_name"] = self._trash_name
-        self.crypto.compress_fd(
-            BytesIO(json.dumps(snapshot_tree_dict).encode("utf-8")), fp)
-        fp.close()
+        # the snapshot entries have the mtimes of this plaintext folder, the
+        # encrypted tree is shared with the other ones
+        replaced = []
+        for pathname, mtime in self._plain_mtimes.items():
+            entry = self.snapshot_tree.get(pathname)
+            if entry is not None:
+                replaced.append((entry, entry.mtime))
+                entry.mtime = mtime
+        try:
+            FileTreeIndex.write(self._snapshot_tree_path(), self.snapshot_tree,
+                                {"trash_name": self._trash_name,
+                                 "rules": self.rule_set.signature(),
+                                 "digest_algorithm": self._digest_algorithm})
+        finally:
+            for entry, mtime in replaced:
+                entry.mtime = mtime
 
     def _load_plain_tree(self):
-        self.plain_tree = FileTree.from_fs(self.plain_folder,
-                                           rule_set=self.rule_set)
+        previous = None
+        if self._fast_scan and self.snapshot_tree is not None and \
+                self._snapshot_rules == self.rule_set.signature() and \
+                self.rule_set.attributes() <= set(['name', 'path']):
+            previous = self.snapshot_tree
+        self.plain_tree = FileTree.from_fs(
+            self.plain_folder, rule_set=self.rule_set, previous=previous,
+            fingerprint_size=self._fingerprint_size,
+            digest_algorithm=self._digest_algorithm)
 
     def _load_snapshot_tree(self):
+        self._close_snapshot_tree()
+        self._snapshot_rules = None
         snapshot_tree_path = self._snapshot_tree_path()
         if not os.path.exists(snapshot_tree_path):
             self.snapshot_tree = FileTree()
+        elif FileTreeIndex.is_index(snapshot_tree_path):
+            self.snapshot_tree = FileTreeIndex(snapshot_tree_path)
+            if "trash_name" in self.snapshot_tree.metadata:
+                self._snapshot_trash_name = \
+                    self.snapshot_tree.metadata["trash_name"]
+            self._snapshot_rules = self.snapshot_tree.metadata.get("rules")
         else:
             fp = open(snapshot_tree_path, "rb")
             try:
-                tree_fd = BytesIO()
+                tree_fd = FileTreeDecoder()
                 self.crypto.decompress_fd(fp, tree_fd)
-                tree_fd.seek(0)
-                snapshot_tree_dict = \
-                    json.loads(tree_fd.getvalue().decode("utf-8"))
-                if "trash_name" in snapshot_tree_dict:
-                    self._snapshot_trash_name = snapshot_tree_dict["trash_name"]
-                self.snapshot_tree = FileTree.from_dict(snapshot_tree_dict)
+                tree_fd.close()
+                if "trash_name" in tree_fd.metadata:
+                    self._snapshot_trash_name = tree_fd.metadata["trash_name"]
+                self.snapshot_tree = tree_fd.tree
             finally:
                 fp.close()
 
+    def _close_snapshot_tree(self):
+        if isinstance(self.snapshot_tree, FileTreeIndex):
+            self.snapshot_tree.close()
+        self.snapshot_tree = None
+
     @staticmethod
     def _ensure_dir(path):
         target_dir = os.path.dirname(path)
         if not os.path.isdir(target_dir):
-            os.makedirs(target_dir)
+            try:
+                os.makedirs(target_dir)
+            except OSError:
+                # made by another job in the meantime
+                if not os.path.isdir(target_dir):
+                    raise
 
     def _delete_file(self, pathname, is_in_encrypted_folder):
         tree, root, target = None, None, None
@@ -451,7 +703,11 @@ class Syncrypto(object):
             tree = self.plain_tree
             root = self.plain_folder
             target = "plaintext folder"
+            self._written_dirnames.add(pathname.rpartition('/')[0])
         file_entry = tree.get(pathname)
+        if file_entry is None:
+            # already removed with its folder
+            return
         fs_path = file_entry.fs_path(root)
         if os.path.isdir(fs_path):
             if is_in_encrypted_folder:
@@ -467,24 +723,412 @@ class Syncrypto(object):
                 self._move_to_plain_trash(file_entry)
             self.info("Delete file %s in %s" % (file_entry.pathname,
                                                 target))
-        tree.remove(pathname)
+        tree.remove_prefix(pathname)
+
+    def _revise_folders(self):
+        """Give the plaintext folders the sync wrote into their mtimes back,
+        the others are left alone as they may be changed in the meantime"""
+        for dirname in self._written_dirnames:
+            entry = self.plain_tree.get(dirname)
+            if entry is None or not entry.isdir:
+                continue
+            fs_path = entry.fs_path(self.plain_folder)
+            if os.path.isdir(fs_path):
+                os.utime(fs_path, (entry.mtime, entry.mtime))
+
+    def _record_folder_mtimes(self):
+        """Keep the mtimes of the plaintext folders for the snapshot tree, so
+        the next fast scan knows which folders are not changed since. The
+        folders the sync wrote into get mtime 0, a file made there during the
+        sync does not show in the mtime given back to them, so they are
+        listed again next time."""
+        for entry in self.plain_tree.iter_folders():
+            encrypted_file = self.encrypted_tree.get(entry.pathname)
+            if encrypted_file is not None and encrypted_file.isdir:
+                if entry.pathname in self._written_dirnames:
+                    self._plain_mtimes[entry.pathname] = 0
+                else:
+                    self._plain_mtimes[entry.pathname] = entry.mtime
+
+    def _plan_sync(self, use_tree_digests):
+        """SyncPlan of the pathnames which differ between the plaintext and
+        the encrypted tree, nothing is changed on disk. Renamed pathnames are
+        moved in the trees right away, the plan starts with their renames on
+        disk and compares what is under them with the snapshot entries at
+        their old pathnames."""
+        plan = self._compare_trees(SyncPlan(), use_tree_digests, {})
+        renames = self._find_renames(plan)
+        if not renames:
+            return plan
+        plan = SyncPlan()
+        renamed = {}
+        for action, pathname, old_pathname in renames:
+            if action == "rename encrypted":
+                self.encrypted_tree.move_prefix(old_pathname, pathname,
+                                                keep_fs_pathname=True)
+            else:
+                self.plain_tree.move_prefix(old_pathname, pathname)
+            plan.add(action, pathname, self.plain_tree.get(pathname),
+                     self.encrypted_tree.get(pathname), old_pathname)
+            renamed[pathname] = old_pathname
+        return self._compare_trees(plan, use_tree_digests, renamed)
+
+    def _undo_renames(self, plan):
+        for item in reversed(plan.actions):
+            if item.action == "rename encrypted":
+                self.encrypted_tree.move_prefix(item.pathname,
+                                                item.old_pathname,
+                                                keep_fs_pathname=True)
+            elif item.action == "rename plain":
+                self.plain_tree.move_prefix(item.pathname, item.old_pathname)
+
+    def _snapshot_file(self, pathname, renamed):
+        """Entry of pathname in the snapshot tree, what is under a renamed
+        pathname of renamed ({pathname: old pathname}) has it at the old
+        pathname"""
+        if renamed:
+            dirname = pathname
+            while dirname != '':
+                old_pathname = renamed.get(dirname)
+                if old_pathname is not None:
+                    return self.snapshot_tree.get(
+                        old_pathname + pathname[len(dirname):])
+                dirname = dirname.rpartition('/')[0]
+        return self.snapshot_tree.get(pathname)
+
+    def _find_renames(self, plan):
+        """[(action, pathname, old pathname)] of the pathnames added by plan
+        which are the same as ones it removes on the same side. A plaintext
+        file is matched by the inode, size, mtime and digest it had in the
+        snapshot tree, a file changed on the encrypted side by the salt of
+        its ciphertext, and a folder by the place of its encrypted folder.
+        What is under a renamed pathname goes with it and is not matched
+        again."""
+        removed = {}
+        for item in plan:
+            if item.action == "remove encrypted":
+                action = "rename encrypted"
+            elif item.action == "remove plain":
+                action = "rename plain"
+            else:
+                continue
+            if item.pathname.startswith(".syncrypto/"):
+                continue
+            # the pathname is removed from one side and unchanged on the
+            # other since the snapshot
+            old_file = self.snapshot_tree.get(item.pathname)
+            if old_file is None:
+                continue
+            if action == "rename encrypted":
+                key = (action, old_file.inode)
+            else:
+                key = (action, self._ciphertext_key(old_file))
+            if key[1] is not None:
+                removed.setdefault(key, []).append((item.pathname, old_file))
+        if not removed:
+            return []
+        renames = []
+        moved = set()
+        for item in plan:
+            if item.action == "encrypt" and item.encrypted_file is None:
+                new_file = item.plain_file
+                key = ("rename encrypted", new_file.inode)
+            elif item.action == "decrypt" and item.plain_file is None:
+                new_file = item.encrypted_file
+                key = ("rename plain", self._ciphertext_key(new_file))
+            else:
+                continue
+            if key not in removed or _is_under(item.pathname, moved):
+                continue
+            for old_pathname, old_file in removed[key]:
+                if not _is_under(old_pathname, moved) and \
+                        self._is_renamed(old_file, new_file):
+                    renames.append((key[0], item.pathname, old_pathname))
+                    moved.add(old_pathname)
+                    moved.add(item.pathname)
+                    break
+        return renames
+
+    @staticmethod
+    def _ciphertext_key(encrypted_file):
+        if encrypted_file.isdir:
+            return encrypted_file.fs_pathname
+        return encrypted_file.salt
+
+    @staticmethod
+    def _is_renamed(old_file, new_file):
+        if old_file.isdir or new_file.isdir:
+            return old_file.isdir == new_file.isdir
+        return old_file.size == new_file.size and \
+            int(old_file.mtime) == int(new_file.mtime) and \
+            old_file.same_content(new_file)
+
+    def _compare_trees(self, plan, use_tree_digests, renamed):
+        """Add the actions for the pathnames which differ between the
+        plaintext and the encrypted tree to plan"""
+        # directories whose contents are not visited, they are the same on
+        # both sides, ignored or moved aside as a conflict copy
+        pruned = set()
+        # the snapshot is only looked up for the pathnames that changed, most
+        # of its entries are never decoded
+        for pathname, entries in merge_sorted_items(
+                (self.plain_tree, self.encrypted_tree),
+                lambda pathname, entries: pathname in pruned):
+            plain_file, encrypted_file = entries
+            if self._is_unchanged(plain_file, encrypted_file):
+                # entries written before fingerprints were taken, or with
+                # another digest algorithm, get those of their plaintext
+                if plain_file.fingerprint is not None and \
+                        encrypted_file.fingerprint is None:
+                    encrypted_file.fingerprint = plain_file.fingerprint
+                if plain_file.digest is not None and \
+                        (encrypted_file.digest is None or
+                         len(encrypted_file.digest) != len(plain_file.digest)):
+                    encrypted_file.digest = plain_file.digest
+                if use_tree_digests and \
+                        self._is_same_subtree(plain_file, encrypted_file):
+                    pruned.add(pathname)
+                continue
+            action = self._compare_file(encrypted_file, plain_file,
+                                        self._snapshot_file(pathname, renamed))
+            if self._debug:
+                self.debug("%s: %s, %s" % (action, encrypted_file, plain_file))
+            if action == "same":
+                if not encrypted_file.isdir:
+                    self.debug("%s is not changed " % plain_file.fs_pathname)
+                continue
+            if action == 'conflict':
+                if plain_file.isdir and encrypted_file.isdir:
+                    continue
+                if plain_file.isdir:
+                    pruned.add(pathname)
+            elif action == 'ignore':
+                if (plain_file is not None and plain_file.isdir) or \
+                        (encrypted_file is not None and encrypted_file.isdir):
+                    pruned.add(pathname)
+            plan.add(action, pathname, plain_file, encrypted_file)
+        return plan
+
+    def _move_encrypted_file(self, pathname, old_pathname, queue):
+        """Move the encrypted file of old_pathname, at pathname in the tree
+        already, into the encrypted folder of its new parent. The pathname in
+        its ciphertext is left as it is. Return whether it was moved."""
+        self.info("Rename %s to %s in encrypted folder" %
+                  (old_pathname, pathname))
+        dirname = pathname.rpartition('/')[0]
+        if dirname == old_pathname.rpartition('/')[0]:
+            return False
+        missing = []
+        while dirname != '' and not self.encrypted_tree.has(dirname):
+            missing.append(dirname)
+            dirname = dirname.rpartition('/')[0]
+        for dirname in reversed(missing):
+            self._encrypt_file(dirname, queue)
+        encrypted_file = self.encrypted_tree.get(pathname)
+        moved_file = encrypted_file.clone()
+        try:
+            self._generate_encrypted_path(moved_file)
+        except GenerateEncryptedFilePathError:
+            return False
+        old_path = encrypted_file.fs_path(self.encrypted_folder)
+        new_path = moved_file.fs_path(self.encrypted_folder)
+        size = len(encrypted_file.fs_pathname)
+        items = list(self.encrypted_tree.iter_prefix(pathname))
+        self.encrypted_tree.remove_prefix(pathname)
+        for item_pathname, f in items:
+            f.fs_pathname = moved_file.fs_pathname + f.fs_pathname[size:]
+            self.encrypted_tree.set(item_pathname, f)
+        self._ensure_dir(new_path)
+        shutil.move(old_path, new_path)
+        self._written_paths.append(new_path)
+        return True
+
+    def _move_plain_file(self, pathname, old_pathname):
+        """Move the plaintext file of old_pathname to pathname, where it is
+        in the tree already"""
+        self.info("Rename %s to %s in plaintext folder" %
+                  (old_pathname, pathname))
+        plain_file = self.plain_tree.get(pathname)
+        old_path = os.path.join(self.plain_folder, *old_pathname.split('/'))
+        new_path = plain_file.fs_path(self.plain_folder)
+        self._ensure_dir(new_path)
+        shutil.move(old_path, new_path)
+        self._written_paths.append(new_path)
+        self._written_dirnames.add(old_pathname.rpartition('/')[0])
+        self._written_dirnames.add(pathname.rpartition('/')[0])
+
+    def _record_plain_files(self):
+        """Give the encrypted entries the inodes of their plaintext files in
+        this folder, the snapshot tree keeps them to find renames. The mtimes
+        of plaintext files with the content of their encrypted entry but
+        another mtime are kept for the snapshot tree too, whether the digest
+        is taken in this sync or the snapshot tree has it from an earlier
+        one."""
+        for pathname, entries in merge_sorted_items(
+                (self.plain_tree, self.encrypted_tree)):
+            plain_file, encrypted_file = entries
+            if plain_file is not None and encrypted_file is not None:
+                encrypted_file.inode = plain_file.inode
+                if plain_file.isdir or \
+                        int(plain_file.mtime) == int(encrypted_file.mtime):
+                    continue
+                if plain_file.same_content(encrypted_file):
+                    self._plain_mtimes[pathname] = plain_file.mtime
+                    continue
+                snapshot_file = self.snapshot_tree.get(pathname)
+                if self._is_equal(plain_file, snapshot_file) and \
+                        self._is_equal(snapshot_file, encrypted_file):
+                    self._plain_mtimes[pathname] = plain_file.mtime
+
+    def _is_checkpoint_due(self, count, size):
+        return (self._checkpoint_files is not None and
+                count >= self._checkpoint_files) or \
+            (self._checkpoint_size is not None and
+             size >= self._checkpoint_size)
+
+    def _checkpoint(self, pathnames):
+        """Save the trees as they are once pathnames are synchronized. The
+        snapshot tree saved is the previous one with only pathnames updated,
+        so the next sync is left with the remaining work."""
+        if not self._checkpointed:
+            snapshot_tree = FileTree()
+            for pathname, entry in self.snapshot_tree.sorted_items():
+                snapshot_tree.set(pathname, entry.copy())
+            self._close_snapshot_tree()
+            self.snapshot_tree = snapshot_tree
+            self._checkpointed = True
+        for pathname in pathnames:
+            entry = self.encrypted_tree.get(pathname)
+            if entry is None:
+                continue
+            snapshot_entry = self.snapshot_tree.get(pathname)
+            if snapshot_entry is not None:
+                if snapshot_entry.isdir and entry.isdir:
+                    continue
+                self.snapshot_tree.remove_prefix(pathname)
+            entry = entry.copy()
+            if entry.isdir:
+                # its contents may not be synchronized yet, a fast scan
+                # has to list the folder again
+                entry.mtime = 0
+            self.snapshot_tree.set(pathname, entry)
+        self.encrypted_tree.update_tree_digests()
+        self._save_trees()
+        self.debug("Checkpoint after %d pathnames" % len(pathnames))
+
+    def _interrupt(self, signum, frame):
+        if self._interrupted is not None:
+            raise KeyboardInterrupt()
+        self._interrupted = signum
+        self.info("Interrupted, stopping at the next checkpoint...")
+
+    def _handle_signals(self):
+        """Stop the sync at a checkpoint on SIGINT and SIGTERM, return the
+        handlers replaced"""
+        handlers = {}
+        for name in ("SIGINT", "SIGTERM"):
+            signum = getattr(signal, name, None)
+            if signum is None:
+                continue
+            try:
+                handlers[signum] = signal.signal(signum, self._interrupt)
+            except ValueError:
+                # signals are only handled in the main thread
+                pass
+        return handlers
 
     @staticmethod
-    def _revise_folder(tree, root):
-        for entry in tree.folders():
-            fs_path = entry.fs_path(root)
-            os.utime(fs_path, (entry.mtime, entry.mtime))
+    def _restore_signals(handlers):
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler if handler is not None
+                          else signal.SIG_DFL)
+
+    def _execute_plan(self, plan):
+        encrypted_remove_list = []
+        plain_remove_list = []
+        # pathnames synchronized since the last checkpoint and their size
+        done_pathnames = []
+        done_size = 0
+        self._checkpointed = False
+        self._interrupted = None
+        # encrypt and decrypt jobs of files, their results are applied in
+        # this thread
+        queue = _JobQueue(self._jobs or 1)
+        try:
+            moved = False
+            for item in plan:
+                if item.action == "rename encrypted":
+                    moved = self._move_encrypted_file(
+                        item.pathname, item.old_pathname, queue) or moved
+                elif item.action == "rename plain":
+                    self._move_plain_file(item.pathname, item.old_pathname)
+            if moved:
+                # the old folders of moved encrypted files may be removed
+                # later, the tree must not have them there any more
+                self._checkpoint([])
+            for item in plan:
+                if self._interrupted is not None:
+                    break
+                action, pathname = item.action, item.pathname
+                plain_file, encrypted_file = item.plain_file, \
+                    item.encrypted_file
+                if action == "remove encrypted":
+                    encrypted_remove_list.append(pathname)
+                elif action == "remove plain":
+                    plain_remove_list.append(pathname)
+                elif action == "encrypt":
+                    self._encrypt_file(pathname, queue)
+                elif action == "decrypt":
+                    self._decrypt_file(pathname, queue)
+                elif action == 'conflict':
+                    plain_path = plain_file.fs_path(self.plain_folder)
+                    conflict_path = self._conflict_path(plain_path)
+                    shutil.move(plain_path, conflict_path)
+                    dirname = plain_file.split()[0]
+                    self._written_dirnames.add(dirname)
+                    conflict_name = os.path.basename(conflict_path)
+                    self.plain_tree.move_prefix(
+                        pathname, dirname + '/' + conflict_name
+                        if dirname != '' else conflict_name)
+                    self._decrypt_file(pathname, queue)
+                    self.info("%s has conflict!" % pathname)
+                elif action == 'ignore':
+                    if encrypted_file is not None:
+                        encrypted_remove_list.append(pathname)
+                    if (plain_file is not None and plain_file.isdir) or \
+                            (encrypted_file is not None and
+                             encrypted_file.isdir):
+                        # the encrypted folder is removed with its contents
+                        self.plain_tree.remove_prefix(pathname)
+                if action in ("encrypt", "decrypt", "conflict"):
+                    done_pathnames.append(pathname)
+                    done_size += item.write_size
+                    if self._is_checkpoint_due(len(done_pathnames),
+                                               done_size):
+                        queue.join()
+                        self._checkpoint(done_pathnames)
+                        done_pathnames = []
+                        done_size = 0
+            queue.join()
+        finally:
+            queue.close()
+
+        if self._interrupted is not None:
+            # removals are left to the next sync, the snapshot still has them
+            self._checkpoint(done_pathnames)
+            raise SyncInterrupted("Synchronizing is interrupted, run it again "
+                                  "to resume")
+
+        for pathname in encrypted_remove_list:
+            self._delete_file(pathname, True)
+        for pathname in plain_remove_list:
+            self._delete_file(pathname, False)
 
-    def _do_sync_folder(self):
+    def _do_sync_folder(self, dry_run=False):
 
         if self.plain_folder is None:
             raise Exception("please specify the plaintext folder to sync files")
 
-        pathnames = list(set(self.plain_tree.pathnames() +
-                             self.encrypted_tree.pathnames()))
-        pathnames.sort()
-        encrypted_remove_list = []
-        plain_remove_list = []
         self.info(("Start synchronizing between encrypted folder '%s' "
                    "and plaintext folder '%s'") % (
             self.encrypted_folder, self.plain_folder
@@ -497,75 +1141,44 @@ class Syncrypto(object):
         self.debug(self.snapshot_tree)
         if os.path.exists(self._plain_rule_path()) \
                 or os.path.exists(self._encrypted_rule_path()):
-            pathnames.append(".syncrypto/rules")
             self.plain_tree.set(".syncrypto/rules",
-                                FileEntry.from_file(self._plain_rule_path(),
-                                                    ".syncrypto/rules"))
-        ignore_prefix = None
-        for pathname in pathnames:
-            if ignore_prefix is not None \
-                    and pathname.startswith(ignore_prefix):
-                self.plain_tree.remove(pathname)
-                self.encrypted_tree.remove(pathname)
-            encrypted_file = self.encrypted_tree.get(pathname)
-            plain_file = self.plain_tree.get(pathname)
-            action = self._compare_file(encrypted_file, plain_file,
-                                        self.snapshot_tree.get(pathname))
-            self.debug("%s: %s, %s" % (action, encrypted_file, plain_file))
-            if action == "remove encrypted":
-                encrypted_remove_list.append(pathname)
-            elif action == "remove plain":
-                plain_remove_list.append(pathname)
-            elif action == "encrypt":
-                encrypted_file = self._encrypt_file(pathname)
-                if encrypted_file is None:
-                    continue
-                self.encrypted_tree.set(pathname, encrypted_file)
-                if not encrypted_file.isdir:
-                    self.info("Encrypt %s to %s" %
-                              (plain_file.fs_pathname,
-                               encrypted_file.fs_pathname))
-            elif action == "decrypt":
-                plain_file = self._decrypt_file(pathname)
-                if plain_file is None:
-                    continue
-                self.plain_tree.set(pathname, plain_file)
-                if not plain_file.isdir:
-                    self.info("Decrypt %s to %s" %
-                              (encrypted_file.fs_pathname,
-                               plain_file.fs_pathname))
-            elif action == "same":
-                if not encrypted_file.isdir:
-                    self.debug("%s is not changed " % plain_file.fs_pathname)
-            elif action == 'conflict':
-                if plain_file.isdir and encrypted_file.isdir:
-                    continue
-                plain_path = plain_file.fs_path(self.plain_folder)
-                shutil.move(plain_path, self._conflict_path(plain_path))
-                if plain_file.isdir:
-                    ignore_prefix = pathname
-                plain_file = self._decrypt_file(pathname)
-                self.plain_tree.set(pathname, plain_file)
-                self.info("%s has conflict!" % plain_file.fs_pathname)
-            elif action == 'ignore':
-                if encrypted_file is not None:
-                    encrypted_remove_list.append(pathname)
-                if (plain_file is not None and plain_file.isdir) \
-                        or \
-                        (encrypted_file is not None and encrypted_file.isdir):
-                    ignore_prefix = pathname+'/'
-
-        for pathname in encrypted_remove_list:
-            self._delete_file(pathname, True)
-        for pathname in plain_remove_list:
-            self._delete_file(pathname, False)
-
-        self._revise_folder(self.plain_tree, self.plain_folder)
+                                FileEntry.from_file(
+                                    self._plain_rule_path(),
+                                    ".syncrypto/rules",
+                                    digest_algorithm=self._digest_algorithm))
+        if self._verify_content and not self._encrypted_folder_is_new:
+            self._verify_plain_digests()
+        self._written_dirnames = set()
+        self._plain_mtimes = {}
+        # the ctime of an encrypted entry is not the one of its plaintext, so
+        # tree digests can not stand for rules on ctime
+        use_tree_digests = not self._encrypted_folder_is_new and \
+            'ctime' not in self.rule_set.attributes()
+        if use_tree_digests:
+            self.plain_tree.update_tree_digests()
+        plan = self._plan_sync(use_tree_digests)
+        if dry_run:
+            self._undo_renames(plan)
+            self._close_snapshot_tree()
+            return plan
+        self._clear_encrypted_tmp_folder()
+        handlers = self._handle_signals()
+        try:
+            self._execute_plan(plan)
+        finally:
+            self._restore_signals(handlers)
+
+        self._revise_folders()
+        if self._fast_scan:
+            self._record_folder_mtimes()
 
         self.debug("encrypted_tree:")
         self.debug(self.encrypted_tree)
         self.debug("plain_tree:")
         self.debug(self.plain_tree)
+        self.encrypted_tree.update_tree_digests()
+        self._record_plain_files()
+        self._close_snapshot_tree()
         self.snapshot_tree = self.encrypted_tree
         self._save_trees()
         self.info(("Finish synchronizing between encrypted folder '%s' "
@@ -574,7 +1187,9 @@ class Syncrypto(object):
         ))
         self._trash_name = self._generate_trash_name()
 
-    def sync_folder(self, reload_tree=True):
+    def sync_folder(self, reload_tree=True, dry_run=False):
+        """Synchronize the encrypted and the plaintext folder. With dry_run
+        nothing is changed and the SyncPlan of the sync is returned."""
         encrypted_folder_lock = LockFile(self.encrypted_folder)
         if encrypted_folder_lock.is_locked():
             self.info("Acquiring the lock of encrypted folder...")
@@ -591,11 +1206,11 @@ class Syncrypto(object):
                 self.debug("Acquired the plaintext folder's lock")
                 if reload_tree:
                     self._load_encrypted_tree()
-                    self._load_plain_tree()
                     self._load_snapshot_tree()
+                    self._load_plain_tree()
                 if self.snapshot_tree is None:
                     self._load_snapshot_tree()
-                self._do_sync_folder()
+                return self._do_sync_folder(dry_run)
 
     def change_password(self, newpass):
         if self.encrypted_tree is None:
@@ -604,7 +1219,7 @@ class Syncrypto(object):
         oldpass = self.crypto.password
         if oldpass == newpass:
             raise ChangeTheSamePassword()
-        for file_entry in self.encrypted_tree.files():
+        for file_entry in self.encrypted_tree.iter_files():
             fs_path = file_entry.fs_path(self.encrypted_folder)
 
             self.crypto.password = oldpass
@@ -615,13 +1230,119 @@ class Syncrypto(object):
 
             string.seek(0)
             self.crypto.password = newpass
-            fp = open(fs_path, 'wb')
-            self.crypto.encrypt_fd(string, fp, file_entry)
+            fp = open(fs_path + TMP_SUFFIX, 'wb')
+            self.crypto.encrypt_fd(
+                string, fp, file_entry,
+                digest_algorithm=digest_algorithm(file_entry.digest) or 'md5')
             fp.close()
+            shutil.copystat(fs_path, fs_path + TMP_SUFFIX)
+            replace_file(fs_path + TMP_SUFFIX, fs_path)
+            self._written_paths.append(fs_path)
         self.crypto.password = newpass
+        sync_paths(self._written_paths)
+        self._written_paths = []
         self._save_encrypted_tree()
 
 
+# an action of a sync plan, with the entries it is decided from, the
+# estimated numbers of bytes to read and write and the old pathname of a
+# rename
+SyncAction = namedtuple('SyncAction', ['action', 'pathname', 'plain_file',
+                                       'encrypted_file', 'read_size',
+                                       'write_size', 'old_pathname'])
+
+
+class SyncPlan(object):
+    """The actions of a sync in the order they are taken, pathnames with no
+    action are left out"""
+
+    def __init__(self):
+        self.actions = []
+
+    def add(self, action, pathname, plain_file, encrypted_file,
+            old_pathname=None):
+        size = 0
+        if action == "encrypt" and not plain_file.isdir:
+            size = plain_file.size
+        elif action in ("decrypt", "conflict") and not encrypted_file.isdir:
+            size = encrypted_file.size
+        self.actions.append(SyncAction(action, pathname, plain_file,
+                                       encrypted_file, size, size,
+                                       old_pathname))
+
+    def __iter__(self):
+        return iter(self.actions)
+
+    def __len__(self):
+        return len(self.actions)
+
+    def totals(self):
+        """{action: (number of pathnames, bytes to read, bytes to write)}"""
+        totals = {}
+        for item in self.actions:
+            count, read_size, write_size = totals.get(item.action, (0, 0, 0))
+            totals[item.action] = (count + 1, read_size + item.read_size,
+                                   write_size + item.write_size)
+        return totals
+
+    def __str__(self):
+        lines = ["%s %s -> %s" % (item.action, item.old_pathname,
+                                  item.pathname)
+                 if item.old_pathname is not None else
+                 "%s %s" % (item.action, item.pathname)
+                 for item in self.actions]
+        read_size, write_size = 0, 0
+        totals = self.totals()
+        for action in sorted(totals):
+            count, action_read_size, action_write_size = totals[action]
+            lines.append("%s: %d pathnames, %d bytes to read, %d bytes to "
+                         "write" % (action, count, action_read_size,
+                                    action_write_size))
+            read_size += action_read_size
+            write_size += action_write_size
+        lines.append("total: %d pathnames, %d bytes to read, %d bytes to "
+                     "write" % (len(self.actions), read_size, write_size))
+        return "\n".join(lines)
+
+
+class _JobQueue(object):
+    """Run jobs in a pool of threads and pass their results to callbacks in
+    the thread adding them, in the order they were added. With one job at a
+    time, jobs run right away in the adding thread."""
+
+    def __init__(self, jobs):
+        self._pool = None
+        if jobs > 1:
+            self._pool = ThreadPool(jobs)
+        # jobs waiting for their results are limited, so their arguments
+        # do not pile up
+        self._limit = jobs * 4
+        self._pending = deque()
+
+    def add(self, func, args, callback):
+        if self._pool is None:
+            callback(func(*args))
+            return
+        self._pending.append((self._pool.apply_async(func, args), callback))
+        while len(self._pending) > self._limit:
+            self._finish_one()
+
+    def _finish_one(self):
+        result, callback = self._pending.popleft()
+        callback(result.get())
+
+    def join(self):
+        """Wait for all the jobs and call their callbacks"""
+        while self._pending:
+            self._finish_one()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
 def _generate_tmp_path(folder=None):
     if folder is None:
         folder = os.getcwd()
@@ -632,6 +1353,23 @@ def _generate_tmp_path(folder=None):
             return path
 
 
+def _is_under(pathname, pathnames):
+    """Whether pathname or one of its parents is in pathnames"""
+    while pathname != '':
+        if pathname in pathnames:
+            return True
+        pathname = pathname.rpartition('/')[0]
+    return False
+
+
+def _try_file_digest(args):
+    path, algorithm = args
+    try:
+        return file_digest(path, algorithm)
+    except EnvironmentError:
+        return None
+
+
 def cli_decrypt_file(crypto, encrypted_path, plain_path=None):
     if not os.path.isfile(encrypted_path):
         print(printable_text(encrypted_path+" is not a file"))
@@ -671,6 +1409,26 @@ def cli_encrypt_file(crypto, plain_path, encrypted_path=None):
     return 0
 
 
+def cli_print_stats(syncrypto, pathname):
+    if not os.path.exists(syncrypto._encrypted_tree_path()):
+        print(printable_text(syncrypto.encrypted_folder +
+                             " is not an encrypted folder"))
+        return 1
+    syncrypto._load_encrypted_tree()
+    pathname = pathname.replace(os.path.sep, '/').strip('/')
+    stats = syncrypto.encrypted_tree.stats(pathname)
+    if stats is None:
+        print(printable_text(pathname+" is not in the encrypted folder"))
+        return 1
+    message = "%s: %d files, %d bytes" % (pathname or '/', stats.files,
+                                          stats.size)
+    if stats.mtime is not None:
+        message += ", last modified at %s" % \
+            datetime.fromtimestamp(stats.mtime).strftime("%Y-%m-%d %H:%M:%S")
+    print(printable_text(message))
+    return 0
+
+
 def main(args=sys.argv[1:]):
 
     from .cli import parser
@@ -716,7 +1474,15 @@ def main(args=sys.argv[1:]):
                               args.plaintext_folder,
                               rule_set=rule_set,
                               rule_file=args.rule_file,
-                              debug=args.debug)
+                              debug=args.debug,
+                              fast_scan=args.fast_scan,
+                              verify_content=args.verify_content,
+                              fingerprint_size=args.fingerprint_size,
+                              fan_out=args.fan_out,
+                              digest_algorithm=args.digest_algorithm,
+                              jobs=args.jobs,
+                              checkpoint_files=args.checkpoint_files,
+                              checkpoint_size=args.checkpoint_size)
         if args.change_password:
             newpass1 = None
             while True:
@@ -729,10 +1495,14 @@ def main(args=sys.argv[1:]):
                 else:
                     break
             syncrypto.change_password(newpass1)
+        elif args.stats is not None:
+            return cli_print_stats(syncrypto, args.stats)
         elif args.print_encrypted_tree:
             print(printable_text(syncrypto.encrypted_tree))
         elif args.plaintext_folder is not None:
-            if args.interval:
+            if args.dry_run:
+                print(printable_text(syncrypto.sync_folder(dry_run=True)))
+            elif args.interval:
                 while True:
                     syncrypto.sync_folder()
                     sleep(args.interval)
@@ -745,3 +1515,6 @@ def main(args=sys.argv[1:]):
     except InvalidFolder as e:
         print(e.args[0])
         return 4
+    except SyncInterrupted as e:
+        print(e.args[0])
+        return 5
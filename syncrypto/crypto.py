@@ -111,7 +111,8 @@ class Crypto(object):
         return FileEntry(pathname, size, None, mtime, mode,
                          footer[:16], False)
 
-    def encrypt_fd(self, in_fd, out_fd, file_entry, flags=0):
+    def encrypt_fd(self, in_fd, out_fd, file_entry, flags=0,
+                   digest_algorithm='md5'):
         """
             +-----------------------------------------------------+
             | Version(1) | Flags(1) | Pathname size(2) | Salt(12) |
@@ -129,6 +130,9 @@ class Crypto(object):
             +-----------------------------------------------------+
 
             * size, mtime, mode are also encrypted
+
+            The content digest of the format is MD5, file_entry gets the
+            digest of digest_algorithm.
         """
         bs = self.block_size
         if file_entry is None:
@@ -157,6 +161,9 @@ class Crypto(object):
 
         finished = False
         md5 = hashlib.md5()
+        content_hash = None
+        if digest_algorithm != 'md5':
+            content_hash = hashlib.new(digest_algorithm)
         rest = b''
         end = False
         while not finished:
@@ -174,6 +181,8 @@ class Crypto(object):
                             pass
                         break
                     md5.update(in_data)
+                    if content_hash is not None:
+                        content_hash.update(in_data)
                     compress_data = compress_obj.compress(in_data)
                     compress_size += len(compress_data)
                     buf.write(compress_data)
@@ -191,6 +200,8 @@ class Crypto(object):
             else:
                 chunk = in_fd.read(self.BUFFER_SIZE)
                 md5.update(chunk)
+                if content_hash is not None:
+                    content_hash.update(chunk)
             if len(chunk) == 0 or len(chunk) % bs != 0:
                 padding_length = (bs - len(chunk) % bs) or bs
                 chunk += padding_length * pack(b'B', padding_length)
@@ -204,6 +215,8 @@ class Crypto(object):
         out_fd.write(encryptor.update(footer))
         out_fd.write(encryptor.update(entire_digest))
         out_fd.write(encryptor.finalize())
+        if content_hash is not None:
+            file_entry.digest = content_hash.digest()
         return file_entry
 
     def decrypt_fd(self, in_fd, out_fd):
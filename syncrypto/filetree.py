@@ -19,13 +19,20 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import unicode_literals
 import binascii
+import hashlib
+import json
+import mmap
 import os
 import os.path
 import re
+import operator
 from datetime import datetime
+from struct import Struct, pack
 import time
-from fnmatch import fnmatch
-from .util import unicode_text, file_digest
+from collections import namedtuple
+from fnmatch import fnmatch, translate
+from .util import unicode_text, file_digest, file_fingerprint, \
+    intern_text, parse_size, replace_file, TMP_SUFFIX
 
 
 class InvalidRuleString(Exception):
@@ -38,17 +45,70 @@ class InvalidRegularExpression(Exception):
 
 class FileEntry(object):
 
+    # the pathname is kept as the parent directory, shared with the siblings
+    # and the other trees, plus the leaf name
+    __slots__ = ("_dirname", "_name", "isdir", "size", "ctime", "mtime",
+                 "mode", "digest", "_fs_pathname", "salt", "tree_digest",
+                 "fingerprint", "inode")
+
+    # files up to this size have their digest computed when scanned
+    DIGEST_SIZE_LIMIT = 10240
+
+    # there are only a handful of distinct modes in a tree, share them
+    _modes = {}
+
+    # stored as _fs_pathname when the fs_pathname equals the pathname
+    _SAME_AS_PATHNAME = object()
+
     def __init__(self, pathname, size, ctime, mtime, mode, digest=None,
                  isdir=False, fs_pathname=None, salt=None):
+        self._fs_pathname = None
         self.pathname = pathname
         self.isdir = isdir
         self.size = size
         self.ctime = ctime
         self.mtime = mtime
-        self.mode = mode
+        self.mode = FileEntry._modes.setdefault(mode, mode)
         self.digest = digest
         self.fs_pathname = fs_pathname
         self.salt = salt
+        # digest of a directory's contents, see FileTree.update_tree_digests
+        self.tree_digest = None
+        # sampled digest of a large file, see util.file_fingerprint
+        self.fingerprint = None
+        # inode number of the plaintext file, to tell renamed files
+        self.inode = None
+
+    def _get_pathname(self):
+        if self._dirname:
+            return self._dirname + '/' + self._name
+        return self._name
+
+    def _set_pathname(self, pathname):
+        if self._fs_pathname is FileEntry._SAME_AS_PATHNAME:
+            self._fs_pathname = self._get_pathname()
+        pos = pathname.rfind('/')
+        if pos < 0:
+            self._dirname = ''
+            self._name = pathname
+        else:
+            self._dirname = intern_text(pathname[:pos])
+            self._name = pathname[pos+1:]
+
+    pathname = property(_get_pathname, _set_pathname)
+
+    def _get_fs_pathname(self):
+        if self._fs_pathname is FileEntry._SAME_AS_PATHNAME:
+            return self._get_pathname()
+        return self._fs_pathname
+
+    def _set_fs_pathname(self, fs_pathname):
+        if fs_pathname is not None and fs_pathname == self._get_pathname():
+            self._fs_pathname = FileEntry._SAME_AS_PATHNAME
+        else:
+            self._fs_pathname = fs_pathname
+
+    fs_pathname = property(_get_fs_pathname, _set_fs_pathname)
 
     def __str__(self):
         t = datetime.fromtimestamp(self.mtime)
@@ -60,13 +120,10 @@ class FileEntry(object):
                              unicode_text(t), self.fs_pathname])
 
     def name(self):
-        return (self.split())[1]
+        return self._name
 
     def split(self):
-        pos = self.pathname.rfind('/')
-        if pos < 0:
-            return '', self.pathname
-        return self.pathname[:pos], self.pathname[pos+1:]
+        return self._dirname, self._name
 
     def fs_path(self, root):
         if os.path.sep != '/':
@@ -82,11 +139,39 @@ class FileEntry(object):
                 d[k] = binascii.hexlify(v).decode('utf-8')
             else:
                 d[k] = v
+        if self.tree_digest is not None:
+            d['tree_digest'] = binascii.hexlify(self.tree_digest).decode(
+                'utf-8')
+        if self.fingerprint is not None:
+            d['fingerprint'] = binascii.hexlify(self.fingerprint).decode(
+                'utf-8')
+        if self.inode is not None:
+            d['inode'] = self.inode
         return d
 
     def clone(self):
-        return FileEntry(self.pathname, self.size, self.ctime, self.mtime,
-                         self.mode, self.digest, self.isdir, self.fs_pathname)
+        entry = FileEntry.__new__(FileEntry)
+        entry._dirname = self._dirname
+        entry._name = self._name
+        entry._fs_pathname = self._fs_pathname
+        entry.isdir = self.isdir
+        entry.size = self.size
+        entry.ctime = self.ctime
+        entry.mtime = self.mtime
+        entry.mode = self.mode
+        entry.digest = self.digest
+        entry.salt = None
+        entry.tree_digest = None
+        entry.fingerprint = self.fingerprint
+        entry.inode = self.inode
+        return entry
+
+    def copy(self):
+        """Clone which keeps the salt and the tree digest"""
+        entry = self.clone()
+        entry.salt = self.salt
+        entry.tree_digest = self.tree_digest
+        return entry
 
     def copy_attr_from(self, target):
         self.isdir = target.isdir
@@ -97,17 +182,46 @@ class FileEntry(object):
             self.mode = target.mode
         self.salt = target.salt
         self.digest = target.digest
+        self.fingerprint = target.fingerprint
+        self.inode = target.inode
+
+    def same_content(self, other):
+        """Whether other stands for the same content, directories always do,
+        files are compared by digest when both have one of the same
+        algorithm, otherwise by size, mtime and fingerprint"""
+        if self.isdir and other.isdir:
+            return True
+        if self.digest is not None and other.digest is not None and \
+                len(self.digest) == len(other.digest):
+            return self.digest == other.digest
+        return self.size == other.size and \
+            int(self.mtime) == int(other.mtime) and \
+            (self.fingerprint is None or other.fingerprint is None or
+             self.fingerprint == other.fingerprint)
 
     @classmethod
     def from_dict(cls, d):
-        if 'digest' in d and d['digest'] is not None:
-            d['digest'] = binascii.unhexlify(d['digest'])
-        if 'salt' in d and d['salt'] is not None:
-            d['salt'] = binascii.unhexlify(d['salt'])
-        return cls(**d)
+        digest = d.get('digest')
+        if digest is not None:
+            digest = binascii.unhexlify(digest)
+        salt = d.get('salt')
+        if salt is not None:
+            salt = binascii.unhexlify(salt)
+        entry = cls(d['pathname'], d['size'], d['ctime'], d['mtime'],
+                    d['mode'], digest, d.get('isdir', False),
+                    d.get('fs_pathname'), salt)
+        if d.get('tree_digest') is not None:
+            entry.tree_digest = binascii.unhexlify(d['tree_digest'])
+        if d.get('fingerprint') is not None:
+            entry.fingerprint = binascii.unhexlify(d['fingerprint'])
+        entry.inode = d.get('inode')
+        return entry
 
     @classmethod
-    def from_file(cls, path, pathname):
+    def from_file(cls, path, pathname, fingerprint_size=None,
+                  digest_algorithm='md5'):
+        """Entry of the file at path, small files get a digest by
+        digest_algorithm, files larger than fingerprint_size a fingerprint"""
         stat = os.stat(path)
         mode = stat.st_mode
         if os.name == 'nt':
@@ -115,11 +229,17 @@ class FileEntry(object):
         size = stat.st_size
         isdir = os.path.isdir(path)
         digest = None
-        if not isdir and size <= 10240:
-            digest = file_digest(path)
-        return cls(pathname, size, stat.st_ctime, stat.st_mtime,
-                   mode, isdir=isdir,
-                   fs_pathname=pathname, digest=digest)
+        if not isdir and size <= cls.DIGEST_SIZE_LIMIT:
+            digest = file_digest(path, digest_algorithm)
+        entry = cls(pathname, size, stat.st_ctime, stat.st_mtime,
+                    mode, isdir=isdir,
+                    fs_pathname=pathname, digest=digest)
+        if not isdir and fingerprint_size is not None and \
+                size > fingerprint_size:
+            entry.fingerprint = file_fingerprint(path, size)
+        # 0 where the platform has no inode numbers
+        entry.inode = stat.st_ino or None
+        return entry
 
     @staticmethod
     def properties():
@@ -153,16 +273,7 @@ class FileRule(object):
             raise ValueError("Unsupported file filter attribute: "+attr)
         self.attr = attr
         if attr == 'size':
-            value = unicode_text(value).lower()
-            unit = value[-1]
-            if unit == 'g':
-                self.value = int(value[:-1]) << 30
-            elif unit == 'm':
-                self.value = int(value[:-1]) << 20
-            elif unit == 'k':
-                self.value = int(value[:-1]) << 10
-            else:
-                self.value = int(value)
+            self.value = parse_size(value)
         elif attr == 'ctime' or attr == 'mtime':
             self.value = time.mktime(datetime.strptime(
                 value, "%Y-%m-%d %H:%M:%S").timetuple())
@@ -252,26 +363,183 @@ class FileRuleSet(object):
         r"\s*(include|exclude|ignore)\s*:\s*(\w+)\s+(\S+)\s+(\".+\"|'.+'|.+)\s*"
     )
 
+    _OPERATORS = {
+        "eq": operator.eq,
+        "ne": operator.ne,
+        "lt": operator.lt,
+        "lte": operator.le,
+        "gt": operator.gt,
+        "gte": operator.ge,
+    }
+
+    # kinds of compiled steps, the first two only need the pathname
+    _STEP_PATTERN = 0
+    _STEP_COMPARE = 1
+    _STEP_STAT = 2
+
+    # the name cache is cleared when it holds more names than this
+    _NAME_CACHE_SIZE = 10000
+
     def __init__(self, default_action="include"):
         self._rules = []
+        self._steps = None
+        # leading steps which only need the name, their decisions are
+        # remembered by name in _name_cache
+        self._name_steps = None
+        self._name_cache = {}
         self.default_action = default_action
 
     def add(self, attr, op, value, action):
-        self._rules.append(FileRule(attr, op, value, action))
+        self.add_rule(FileRule(attr, op, value, action))
 
     def add_rule(self, rule):
         self._rules.append(rule)
+        self._steps = None
+        self._name_steps = None
+        self._name_cache = {}
 
     def add_rule_by_string(self, rule_string, action=None):
-        self._rules.append(self.parse(rule_string, action))
+        self.add_rule(self.parse(rule_string, action))
 
-    def test(self, file_entry):
+    def attributes(self):
+        return set([rule.attr for rule in self._rules])
+
+    def signature(self):
+        """Text identifying the rules, rule sets with the same rules in the
+        same order have the same signature"""
+        rules = []
         for rule in self._rules:
-            action = rule.test(file_entry)
+            value = rule.value
+            if rule.op == 'regexp':
+                value = value.pattern
+            rules.append([rule.action, rule.attr, rule.op, value])
+        return json.dumps([self.default_action, rules])
+
+    def test(self, file_entry):
+        if file_entry is None:
+            return self.default_action
+        return self._evaluate(file_entry.pathname, file_entry)
+
+    def test_pathname(self, pathname):
+        """Decide the action from the pathname alone, return None when a rule
+        needing the file's stat would have to be evaluated first"""
+        return self._evaluate(pathname, None)
+
+    def _evaluate(self, pathname, file_entry):
+        steps = self._steps
+        if steps is None:
+            steps = self._compile()
+        name = None
+        if self._name_steps:
+            name = pathname[pathname.rfind('/')+1:]
+            cache = self._name_cache
+            try:
+                action = cache[name]
+            except KeyError:
+                action = self._evaluate_name(name)
+                if len(cache) >= self._NAME_CACHE_SIZE:
+                    cache.clear()
+                cache[name] = action
             if action is not None:
                 return action
+        for kind, use_name, matcher, value, action in steps:
+            if kind == self._STEP_STAT:
+                if file_entry is None:
+                    return None
+                if matcher(getattr(file_entry, use_name), value):
+                    return action
+                continue
+            if use_name:
+                if name is None:
+                    name = pathname[pathname.rfind('/')+1:]
+                subject = name
+            else:
+                subject = pathname
+            if kind == self._STEP_PATTERN:
+                if matcher(subject) is not None:
+                    return action
+            elif matcher(subject, value):
+                return action
         return self.default_action
 
+    def _evaluate_name(self, name):
+        """Action of the first leading name step matching name, or None"""
+        for kind, use_name, matcher, value, action in self._name_steps:
+            if kind == self._STEP_PATTERN:
+                if matcher(name) is not None:
+                    return action
+            elif matcher(name, value):
+                return action
+        return None
+
+    def _compile(self):
+        """Compile the rules into a list of steps, consecutive name/path rules
+        with the same action are merged into one regular expression. The
+        leading steps on the name are split into _name_steps."""
+        steps = []
+        patterns = []
+        group = None
+        for rule in self._rules:
+            pattern, flags = self._rule_pattern(rule)
+            key = (rule.attr == 'name', rule.action, flags)
+            if patterns and (pattern is None or key != group):
+                steps.append(self._pattern_step(group, patterns))
+                patterns = []
+            if pattern is not None:
+                patterns.append(pattern)
+                group = key
+            elif rule.attr == 'name' or rule.attr == 'path':
+                steps.append((self._STEP_COMPARE, rule.attr == 'name',
+                              self._OPERATORS.get(rule.op,
+                                                  getattr(rule, rule.op)),
+                              rule.value, rule.action))
+            else:
+                steps.append((self._STEP_STAT, rule.attr,
+                              self._OPERATORS.get(rule.op,
+                                                  getattr(rule, rule.op)),
+                              rule.value, rule.action))
+        if patterns:
+            steps.append(self._pattern_step(group, patterns))
+        count = 0
+        while count < len(steps) and steps[count][0] != self._STEP_STAT \
+                and steps[count][1]:
+            count += 1
+        self._name_steps = steps[:count]
+        self._steps = steps[count:]
+        return self._steps
+
+    def _pattern_step(self, group, patterns):
+        use_name, action, flags = group
+        if len(patterns) == 1:
+            regexp = patterns[0]
+        else:
+            regexp = "|".join(["(?:%s)" % p for p in patterns])
+        return (self._STEP_PATTERN, use_name,
+                re.compile(regexp, flags).match, None, action)
+
+    @staticmethod
+    def _rule_pattern(rule):
+        """Regular expression equivalent of a name/path rule and the flags to
+        compile it with, the pattern is None if the rule can not be merged"""
+        if rule.attr != 'name' and rule.attr != 'path':
+            return None, 0
+        if rule.op == 'eq':
+            return re.escape(rule.value) + r"\Z", 0
+        if rule.op == 'match':
+            # fnmatch compares normalized case, like os.path.normcase does
+            flags = re.S
+            if os.path.normcase('A') == 'a':
+                flags |= re.I
+            pattern = translate(rule.value)
+            if pattern.endswith("(?ms)"):
+                pattern = pattern[:-5]
+            return pattern, flags
+        if rule.op == 'regexp':
+            # groups and inline flags do not survive being combined
+            if rule.value.groups == 0 and "(?" not in rule.value.pattern:
+                return rule.value.pattern, 0
+        return None, 0
+
     @classmethod
     def parse(cls, rule_string, action=None):
         if action is None:
@@ -289,107 +557,1030 @@ class FileRuleSet(object):
                         action)
 
 
+def _split_pathname(pathname):
+    pos = pathname.rfind('/')
+    if pos < 0:
+        return '', pathname
+    return pathname[:pos], pathname[pos+1:]
+
+
+# aggregates of a subtree: total size and number of files, newest mtime
+TreeStats = namedtuple('TreeStats', ['size', 'files', 'mtime'])
+
+# a difference between two trees, kind is "added", "removed", "modified" or
+# "type changed", old and new are the entries of the pathname or None
+TreeChange = namedtuple('TreeChange', ['kind', 'pathname', 'old', 'new'])
+
+
 class FileTree(object):
 
     def __init__(self, table=None):
-        self._table = table
-        if self._table is None:
-            self._table = {}
+        # directory pathname -> {name: entry} of the entries within it, a
+        # None entry is a directory only known as the parent of other entries
+        self._dirs = {}
+        # directory pathname -> sorted names within it, built when needed and
+        # dropped when a name is added or removed, never changed in place as
+        # it may be iterated while the tree is changed
+        self._sorted_names = {}
+        self._size = 0
+        self._folders = set()
+        self._fs_index = None
+        # directory pathname -> TreeStats, dropped for a directory and its
+        # parents when something under it changes, see stats()
+        self._stats = {}
+        if table is not None:
+            for pathname in table:
+                self.set(pathname, table[pathname])
+
+    def __len__(self):
+        return self._size
 
     def pathnames(self):
-        return list(self._table)
+        return [pathname for pathname, f in self.items()]
 
     def files(self):
-        files = []
-        for pathname in self._table:
-            f = self._table[pathname]
-            if not f.isdir:
-                files.append(f)
-        return files
+        return list(self.iter_files())
 
     def folders(self):
-        folders = []
-        for pathname in self._table:
-            f = self._table[pathname]
-            if f.isdir:
-                folders.append(f)
-        return folders 
+        return list(self.iter_folders())
+
+    def items(self):
+        for dirname, children in self._dirs.items():
+            prefix = dirname + '/' if dirname != '' else ''
+            for name, f in children.items():
+                if f is not None:
+                    yield prefix + name, f
+
+    def sorted_items(self, prune=None):
+        """(pathname, entry) pairs ordered by their path components, so every
+        directory comes right before its contents. The contents of a directory
+        are left out when prune(pathname, entry) returns True"""
+        return self._sorted_items_under('', prune)
+
+    def _sorted_items_under(self, dirname, prune=None):
+        dirs = self._dirs
+        sorted_names = self._get_sorted_names
+        stack = [(dirname, iter(sorted_names(dirname)))]
+        while stack:
+            dirname, names = stack[-1]
+            name = next(names, None)
+            if name is None:
+                stack.pop()
+                continue
+            pathname = dirname + '/' + name if dirname != '' else name
+            f = dirs.get(dirname, {}).get(name)
+            if f is not None:
+                yield pathname, f
+                if prune is not None and prune(pathname, f):
+                    continue
+            if pathname in dirs:
+                stack.append((pathname, iter(sorted_names(pathname))))
+
+    def _get_sorted_names(self, dirname):
+        names = self._sorted_names.get(dirname)
+        if names is None:
+            children = self._dirs.get(dirname)
+            if children is None:
+                return []
+            names = self._sorted_names[dirname] = sorted(children)
+        return names
+
+    def update_tree_digests(self):
+        """Set the tree_digest of every directory entry to a digest of the
+        names, sizes, mtimes and digests of everything under it, directories
+        with the same tree_digest hold entries that compare equal"""
+        dirs = self._dirs
+        tree_digests = {}
+        limit = FileEntry.DIGEST_SIZE_LIMIT
+        file_record = Struct(b'!Qq').pack
+        # deepest directories first so children are done before parents
+        for dirname in sorted(dirs, key=lambda d: d.count('/') + (d != ''),
+                              reverse=True):
+            children = dirs[dirname]
+            prefix = dirname + '/' if dirname != '' else ''
+            parts = []
+            for name in self._get_sorted_names(dirname):
+                f = children[name]
+                parts.append(name.encode("utf-8"))
+                if f is None or f.isdir:
+                    parts.append(b'\x00d' +
+                                 tree_digests.get(prefix + name, b''))
+                elif f.digest is not None and f.size <= limit:
+                    parts.append(b'\x00F' +
+                                 file_record(f.size, int(f.mtime)) + f.digest)
+                elif f.fingerprint is not None:
+                    parts.append(b'\x00S' + file_record(f.size, int(f.mtime)) +
+                                 f.fingerprint)
+                else:
+                    parts.append(b'\x00f' +
+                                 file_record(f.size, int(f.mtime)))
+            tree_digests[dirname] = hashlib.md5(b''.join(parts)).digest()
+        empty_digest = hashlib.md5().digest()
+        for pathname in self._folders:
+            f = self.get(pathname)
+            if f is not None:
+                f.tree_digest = tree_digests.get(pathname, empty_digest)
+
+    def iter_files(self):
+        for children in self._dirs.values():
+            for f in children.values():
+                if f is not None and not f.isdir:
+                    yield f
+
+    def iter_folders(self):
+        for pathname in self._folders:
+            f = self.get(pathname)
+            if f is not None and f.isdir:
+                yield f
+
+    def count_files(self):
+        return self._size - len(self._folders)
+
+    def count_folders(self):
+        return len(self._folders)
 
     def get(self, pathname):
-        if pathname in self._table:
-            return self._table[pathname]
-        return None
+        pos = pathname.rfind('/')
+        if pos < 0:
+            children = self._dirs.get('')
+            name = pathname
+        else:
+            children = self._dirs.get(pathname[:pos])
+            name = pathname[pos+1:]
+        if children is None:
+            return None
+        return children.get(name)
 
     def set(self, pathname, file_entry):
-        self._table[pathname] = file_entry
+        if file_entry is None:
+            self.remove(pathname)
+            return
+        dirname, name = _split_pathname(pathname)
+        self._insert(dirname, name, file_entry)
+
+    def _insert(self, dirname, name, file_entry):
+        children = self._dirs.get(dirname)
+        if children is None:
+            children = self._add_dir(dirname)
+        old_entry = children.get(name)
+        if old_entry is None:
+            self._size += 1
+            if name not in children:
+                self._sorted_names.pop(dirname, None)
+        else:
+            self._unindex(dirname, name, old_entry)
+        if file_entry._name == name:
+            name = file_entry._name
+        children[name] = file_entry
+        self._index(dirname, name, file_entry)
 
     def remove(self, pathname):
-        if pathname in self._table:
-            del self._table[pathname]
+        dirname, name = _split_pathname(pathname)
+        children = self._dirs.get(dirname)
+        if children is None or children.get(name) is None:
+            return
+        self._unindex(dirname, name, children[name])
+        self._size -= 1
+        if pathname in self._dirs:
+            children[name] = None
+        else:
+            del children[name]
+            self._sorted_names.pop(dirname, None)
+            self._remove_empty_dir(dirname)
+
+    def iter_prefix(self, pathname):
+        """(pathname, entry) pairs of pathname and everything under it, in the
+        order of sorted_items()"""
+        f = self.get(pathname)
+        if f is not None:
+            yield pathname, f
+        if pathname != '' and pathname in self._dirs:
+            for item in self._sorted_items_under(pathname):
+                yield item
+
+    def remove_prefix(self, pathname):
+        """Remove pathname and everything under it, return the number of
+        removed entries"""
+        dirname, name = _split_pathname(pathname)
+        children = self._dirs.get(dirname)
+        if children is None or name not in children:
+            return 0
+        dirs = self._dirs
+        removed = 0
+        stack = [pathname]
+        while stack:
+            sub_dirname = stack.pop()
+            sub_children = dirs.pop(sub_dirname, None)
+            if sub_children is None:
+                continue
+            self._sorted_names.pop(sub_dirname, None)
+            for sub_name, f in sub_children.items():
+                if f is not None:
+                    self._unindex(sub_dirname, sub_name, f)
+                    removed += 1
+                stack.append(sub_dirname + '/' + sub_name)
+        f = children.pop(name)
+        if f is not None:
+            self._unindex(dirname, name, f)
+            removed += 1
+        self._sorted_names.pop(dirname, None)
+        self._size -= removed
+        self._remove_empty_dir(dirname)
+        return removed
+
+    def move_prefix(self, pathname, new_pathname, keep_fs_pathname=False):
+        """Move pathname and everything under it to new_pathname, which should
+        not exist. Entries whose fs_pathname is their pathname keep it that
+        way, the others keep their fs_pathname. With keep_fs_pathname all of
+        them keep it, like the entries of the encrypted tree, whose files do
+        not move."""
+        items = list(self.iter_prefix(pathname))
+        self.remove_prefix(pathname)
+        size = len(pathname)
+        for old_pathname, f in items:
+            same = f._fs_pathname is FileEntry._SAME_AS_PATHNAME
+            f.pathname = new_pathname + old_pathname[size:]
+            if keep_fs_pathname:
+                f.fs_pathname = f._fs_pathname
+            elif same:
+                f._fs_pathname = FileEntry._SAME_AS_PATHNAME
+            self.set(f.pathname, f)
 
     def has(self, pathname):
-        return pathname in self._table
+        return self.get(pathname) is not None
 
     def has_fs_pathname(self, fs_pathname):
-        for f in self._table.values():
-            if f.fs_pathname == fs_pathname:
-                return True
-        return False
+        return fs_pathname in self._get_fs_index()
 
-    def walk_tree(self, path, rule_set, pathname=''):
-        isfile = os.path.isfile(path)
-        isdir = os.path.isdir(path)
-        if (isfile or isdir) and pathname != '':
-            file_entry = FileEntry.from_file(path, pathname)
-            if rule_set is None:
-                self._table[pathname] = file_entry
+    def get_by_fs_pathname(self, fs_pathname):
+        return self._get_fs_index().get(fs_pathname)
+
+    def _add_dir(self, dirname):
+        dirname = intern_text(dirname)
+        children = self._dirs[dirname] = {}
+        if dirname != '':
+            parent, name = _split_pathname(dirname)
+            siblings = self._dirs.get(parent)
+            if siblings is None:
+                siblings = self._add_dir(parent)
+            if name not in siblings:
+                siblings[name] = None
+                self._sorted_names.pop(parent, None)
+        return children
+
+    def _remove_empty_dir(self, dirname):
+        while dirname != '' and not self._dirs[dirname]:
+            del self._dirs[dirname]
+            self._sorted_names.pop(dirname, None)
+            dirname, name = _split_pathname(dirname)
+            siblings = self._dirs[dirname]
+            if siblings.get(name) is not None:
+                break
+            del siblings[name]
+            self._sorted_names.pop(dirname, None)
+
+    def _get_fs_index(self):
+        # only the encrypted tree is looked up by fs_pathname, build it lazily
+        if self._fs_index is None:
+            self._fs_index = {}
+            for children in self._dirs.values():
+                for f in children.values():
+                    if f is not None and f.fs_pathname is not None:
+                        self._fs_index[f.fs_pathname] = f
+        return self._fs_index
+
+    def stats(self, pathname=''):
+        """TreeStats of pathname, the total size and number of the files
+        under it and their newest mtime, or None when pathname is not in the
+        tree. The aggregates of a directory are kept until something under it
+        changes, entries changed in place should be set again."""
+        if pathname != '':
+            f = self.get(pathname)
+            if f is not None and not f.isdir:
+                return TreeStats(f.size, 1, f.mtime)
+            if f is None and pathname not in self._dirs:
+                return None
+        return self._dir_stats(pathname)
+
+    def diff(self, other):
+        """Yield a TreeChange for every pathname changed in this tree since
+        the tree other, a FileTree or FileTreeIndex, in the order of
+        sorted_items(). Directories with the same tree digest in both trees
+        are not looked into. The contents of an added or removed directory
+        are yielded too."""
+        for pathname, (new, old) in merge_sorted_items(
+                (self, other), _is_same_subtree):
+            if old is None:
+                yield TreeChange("added", pathname, None, new)
+            elif new is None:
+                yield TreeChange("removed", pathname, old, None)
+            elif old.isdir != new.isdir:
+                yield TreeChange("type changed", pathname, old, new)
+            elif not new.same_content(old):
+                yield TreeChange("modified", pathname, old, new)
+
+    def _dir_stats(self, dirname):
+        stats = self._stats.get(dirname)
+        if stats is not None:
+            return stats
+        size, files, mtime = 0, 0, None
+        prefix = dirname + '/' if dirname != '' else ''
+        for name, f in self._dirs.get(dirname, {}).items():
+            if f is None or f.isdir:
+                sub_stats = self._dir_stats(prefix + name)
+                size += sub_stats.size
+                files += sub_stats.files
+                sub_mtime = sub_stats.mtime
             else:
+                size += f.size
+                files += 1
+                sub_mtime = f.mtime
+            if sub_mtime is not None and (mtime is None or sub_mtime > mtime):
+                mtime = sub_mtime
+        stats = self._stats[dirname] = TreeStats(size, files, mtime)
+        return stats
+
+    def _invalidate_stats(self, dirname):
+        # a directory with aggregates has them for all its subdirectories,
+        # so the first parent without them ends the walk
+        stats = self._stats
+        while dirname in stats:
+            del stats[dirname]
+            if dirname == '':
+                break
+            dirname = _split_pathname(dirname)[0]
+
+    def _index(self, dirname, name, file_entry):
+        self._invalidate_stats(dirname)
+        if file_entry.isdir:
+            self._folders.add(intern_text(
+                dirname + '/' + name if dirname != '' else name))
+        if self._fs_index is not None and file_entry.fs_pathname is not None:
+            self._fs_index[file_entry.fs_pathname] = file_entry
+
+    def _unindex(self, dirname, name, file_entry):
+        self._invalidate_stats(dirname)
+        if file_entry.isdir:
+            self._folders.discard(
+                dirname + '/' + name if dirname != '' else name)
+        if self._fs_index is not None and \
+                self._fs_index.get(file_entry.fs_pathname) is file_entry:
+            del self._fs_index[file_entry.fs_pathname]
+
+    def names(self, dirname):
+        """Names of the entries directly in the directory dirname"""
+        return list(self._dirs.get(dirname, ()))
+
+    def count_names(self, dirname):
+        """Number of the entries directly in the directory dirname"""
+        return len(self._dirs.get(dirname, ()))
+
+    def walk_tree(self, path, rule_set, pathname='', previous=None,
+                  fingerprint_size=None, digest_algorithm='md5'):
+        action = "include"
+        if rule_set is not None and pathname != '':
+            # rules only on the pathname are decided before stat the file
+            action = rule_set.test_pathname(pathname)
+            if action is not None and action != "include":
+                return
+        isdir = os.path.isdir(path)
+        names = None
+        if pathname != '' and (isdir or os.path.isfile(path)):
+            file_entry = FileEntry.from_file(path, pathname, fingerprint_size,
+                                             digest_algorithm)
+            if action is None:
                 action = rule_set.test(file_entry)
-                if action == "include":
-                    self._table[pathname] = file_entry
-                else:
-                    return
+            if action != "include":
+                return
+            self.set(pathname, file_entry)
+            if isdir and previous is not None:
+                # the listing of a directory is not changed when its mtime
+                # is the one in the previous tree
+                previous_entry = previous.get(pathname)
+                if previous_entry is not None and previous_entry.isdir \
+                        and previous_entry.mtime == file_entry.mtime:
+                    names = previous.names(pathname)
         if not isdir:
             return
-        for name in os.listdir(path):
+        if names is None:
+            names = os.listdir(path)
+        for name in names:
             if name == '.' or name == '..' \
-                    or name == '.syncrypto' or name == '_syncrypto':
+                    or name == '.syncrypto' or name == '_syncrypto' \
+                    or name.endswith(TMP_SUFFIX):
                 continue
             sub_pathname = pathname+'/'+name
             if pathname == '':
                 sub_pathname = name
-            self.walk_tree(path+os.path.sep+name, rule_set, sub_pathname)
+            self.walk_tree(path+os.path.sep+name, rule_set, sub_pathname,
+                           previous, fingerprint_size, digest_algorithm)
 
     def __str__(self):
-        table = self._table
         s = ""
-        for key in table:
-            item = table[key]
+        for pathname, item in self.items():
             s += unicode_text(item)+"\n"
         return s
 
     def to_dict(self):
         table = {}
-        for pathname in self._table:
-            f = self._table[pathname]
-            if f is not None:
-                table[pathname] = f.to_dict()
+        for pathname, f in self.items():
+            table[pathname] = f.to_dict()
         return {
             'table': table,
         }
 
     @classmethod
-    def from_fs(cls, root, table=None, rule_set=None):
+    def from_fs(cls, root, table=None, rule_set=None, previous=None,
+                fingerprint_size=None, digest_algorithm='md5'):
+        """Build the tree of the folder root. When previous, a tree of the
+        same folder, is given, directories whose mtime did not change since
+        are not listed again, their names are taken from previous and only
+        stat. It is only correct when the rules do not depend on stat. Files
+        larger than fingerprint_size get a fingerprint, small files a digest
+        by digest_algorithm."""
         filetree = cls(table)
-        filetree.walk_tree(root, rule_set)
+        filetree.walk_tree(root, rule_set, previous=previous,
+                           fingerprint_size=fingerprint_size,
+                           digest_algorithm=digest_algorithm)
         return filetree
 
     @classmethod
     def from_dict(cls, d):
-        table = {}
+        filetree = cls()
         if 'table' in d:
             t = d['table']
             for pathname in t:
-                f = t[pathname]
-                table[pathname] = FileEntry.from_dict(f)
-        return cls(table)
+                filetree.set(pathname, FileEntry.from_dict(t[pathname]))
+        return filetree
+
+
+def _is_same_subtree(pathname, entries):
+    first = entries[0]
+    if first is None or not first.isdir or first.tree_digest is None:
+        return False
+    for f in entries[1:]:
+        if f is None or not f.isdir or f.tree_digest != first.tree_digest:
+            return False
+    return True
+
+
+def merge_sorted_items(trees, prune=None):
+    """Join the sorted_items() of the trees in one pass, yield (pathname,
+    entries) for every pathname in any of the trees, entries holds the entry
+    of each tree or None. The contents of a directory are left out of all the
+    trees when prune(pathname, entries) returns True."""
+    pruned = [None]
+
+    def prune_tree(pathname, f):
+        return pathname == pruned[0]
+
+    iterators = [tree.sorted_items(prune_tree) for tree in trees]
+    heads = [next(iterator, None) for iterator in iterators]
+    # '\0' sorts before any character, so keys compare in component order
+    keys = [head[0].replace('/', '\x00') if head is not None else None
+            for head in heads]
+    while True:
+        current = None
+        for key in keys:
+            if key is not None and (current is None or key < current):
+                current = key
+        if current is None:
+            return
+        pathname = None
+        entries = []
+        for i, key in enumerate(keys):
+            if key == current:
+                pathname = heads[i][0]
+                entries.append(heads[i][1])
+            else:
+                entries.append(None)
+        entries = tuple(entries)
+        yield pathname, entries
+        if prune is not None and prune(pathname, entries):
+            pruned[0] = pathname
+        for i, key in enumerate(keys):
+            if key == current:
+                heads[i] = next(iterators[i], None)
+                keys[i] = heads[i][0].replace('/', '\x00') \
+                    if heads[i] is not None else None
+        pruned[0] = None
+
+
+class InvalidFileTreeData(Exception):
+    pass
+
+
+class FileTreeEncoder(object):
+    """
+        File-like object producing the binary form of a file tree, it is read
+        by Crypto.encrypt_fd/compress_fd, so the tree is never held in memory
+        as a whole serialized blob.
+
+            +--------------------------------------------------------+
+            | Magic(4) | Version(1) |                                |
+            +--------------------------------------------------------+
+            | META(1) | length(4) |       metadata in JSON           |
+            +--------------------------------------------------------+
+            | DIRECTORY(1) | length(4) |  directory pathname         |
+            +--------------------------------------------------------+
+            | ENTRY(1) | flags(2) | directory id(4) | name length(2) |
+            | fs_pathname length(2) | size(8) | ctime(8) | mtime(8) |
+            | mode(4) | [digest length(1) | digest] |                |
+            | [salt length(1) | salt] | [tree digest length(1) |      |
+            | tree digest] | [fingerprint length(1) | fingerprint] |  |
+            | [inode length(1) | inode(8)] | name | fs_pathname      |
+            +--------------------------------------------------------+
+            |                          ...                           |
+            +--------------------------------------------------------+
+            | STATS(1) | length(4) | size(8) | files(8) | mtime(8) |  |
+            | has mtime(1) | directory pathname                      |
+            +--------------------------------------------------------+
+            |                          ...                           |
+            +--------------------------------------------------------+
+            | END(1) |                                               |
+            +--------------------------------------------------------+
+
+        Directory pathnames are written once and referred by their order of
+        appearance, entries follow the directory they are in. The aggregates
+        of the directories (see FileTree.stats) follow all the entries.
+    """
+
+    MAGIC = b'\x00SFT'
+
+    VERSION = 0x5
+
+    META = 0x1
+    DIRECTORY = 0x2
+    ENTRY = 0x3
+    END = 0x4
+    STATS = 0x5
+
+    FLAG_ISDIR = 0x1
+    FLAG_CTIME = 0x2
+    FLAG_MODE = 0x4
+    FLAG_DIGEST = 0x8
+    FLAG_SALT = 0x10
+    FLAG_FS_SAME = 0x20
+    FLAG_FS_PATHNAME = 0x40
+    FLAG_TREE_DIGEST = 0x80
+    FLAG_FINGERPRINT = 0x100
+    FLAG_INODE = 0x200
+
+    RECORD_HEADER = Struct(b'!BI')
+    ENTRY_HEADER = Struct(b'!HIHHQddi')
+    STATS_BODY = Struct(b'!QQdB')
+
+    CHUNK_SIZE = 1024 * 64
+
+    def __init__(self, file_tree, metadata=None):
+        self._chunks = self._generate(file_tree, metadata or {})
+        self._buffer = b''
+
+    def read(self, size=-1):
+        buf = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            buf.append(chunk)
+            length += len(chunk)
+        data = b''.join(buf)
+        if size < 0:
+            size = length
+        self._buffer = data[size:]
+        return data[:size]
+
+    def _generate(self, file_tree, metadata):
+        yield self.MAGIC + pack(b'B', self.VERSION)
+        meta = json.dumps(metadata).encode("utf-8")
+        yield self.RECORD_HEADER.pack(self.META, len(meta)) + meta
+        buf = []
+        length = 0
+        directory_id = 0
+        for dirname, children in file_tree._dirs.items():
+            records = []
+            for name, f in children.items():
+                if f is not None:
+                    records.append(self._entry_record(directory_id, name, f))
+            if not records:
+                continue
+            dirname = dirname.encode("utf-8")
+            buf.append(self.RECORD_HEADER.pack(self.DIRECTORY, len(dirname)))
+            buf.append(dirname)
+            buf.extend(records)
+            directory_id += 1
+            length += len(dirname) + sum([len(r) for r in records])
+            if length >= self.CHUNK_SIZE:
+                yield b''.join(buf)
+                buf = []
+                length = 0
+        file_tree.stats()
+        for dirname, stats in file_tree._stats.items():
+            if dirname != '' and dirname not in file_tree._dirs and \
+                    dirname not in file_tree._folders:
+                continue
+            dirname = dirname.encode("utf-8")
+            buf.append(self.RECORD_HEADER.pack(self.STATS, len(dirname)))
+            buf.append(self.STATS_BODY.pack(
+                stats.size, stats.files,
+                stats.mtime if stats.mtime is not None else 0.0,
+                stats.mtime is not None))
+            buf.append(dirname)
+        buf.append(pack(b'B', self.END))
+        yield b''.join(buf)
+
+    @classmethod
+    def _entry_record(cls, directory_id, name, f):
+        flags = 0
+        if f.isdir:
+            flags |= cls.FLAG_ISDIR
+        ctime = 0.0
+        if f.ctime is not None:
+            flags |= cls.FLAG_CTIME
+            ctime = f.ctime
+        mode = 0
+        if f.mode is not None:
+            flags |= cls.FLAG_MODE
+            mode = f.mode
+        optional = []
+        if f.digest is not None:
+            flags |= cls.FLAG_DIGEST
+            optional.append(pack(b'B', len(f.digest)) + f.digest)
+        if f.salt is not None:
+            flags |= cls.FLAG_SALT
+            optional.append(pack(b'B', len(f.salt)) + f.salt)
+        if f.tree_digest is not None:
+            flags |= cls.FLAG_TREE_DIGEST
+            optional.append(pack(b'B', len(f.tree_digest)) + f.tree_digest)
+        if f.fingerprint is not None:
+            flags |= cls.FLAG_FINGERPRINT
+            optional.append(pack(b'B', len(f.fingerprint)) + f.fingerprint)
+        if f.inode is not None:
+            flags |= cls.FLAG_INODE
+            optional.append(pack(b'!BQ', 8, f.inode))
+        fs_pathname = b''
+        if f._fs_pathname is FileEntry._SAME_AS_PATHNAME:
+            flags |= cls.FLAG_FS_SAME
+        elif f._fs_pathname is not None:
+            flags |= cls.FLAG_FS_PATHNAME
+            fs_pathname = f._fs_pathname.encode("utf-8")
+        name = name.encode("utf-8")
+        optional.append(name)
+        optional.append(fs_pathname)
+        return pack(b'B', cls.ENTRY) + cls.ENTRY_HEADER.pack(
+            flags, directory_id, len(name), len(fs_pathname), f.size,
+            ctime, f.mtime, mode) + b''.join(optional)
+
+
+_BYTE = Struct(b'B')
+_INODE = Struct(b'!Q')
+
+
+def _decode_entry(buf, pos, end, directories):
+    """Decode the entry record at pos, return the entry and the position after
+    the record, or None and pos if the record is not complete"""
+    start = pos + 1 + FileTreeEncoder.ENTRY_HEADER.size
+    if start > end:
+        return None, pos
+    (flags, directory_id, name_size, fs_size, size, ctime, mtime,
+     mode) = FileTreeEncoder.ENTRY_HEADER.unpack_from(buf, pos + 1)
+    optional = []
+    for flag in (FileTreeEncoder.FLAG_DIGEST, FileTreeEncoder.FLAG_SALT,
+                 FileTreeEncoder.FLAG_TREE_DIGEST,
+                 FileTreeEncoder.FLAG_FINGERPRINT,
+                 FileTreeEncoder.FLAG_INODE):
+        value = None
+        if flags & flag:
+            if start >= end:
+                return None, pos
+            length = _BYTE.unpack_from(buf, start)[0]
+            if start + 1 + length > end:
+                return None, pos
+            value = bytes(buf[start+1:start+1+length])
+            start += 1 + length
+        optional.append(value)
+    digest, salt, tree_digest, fingerprint, inode = optional
+    if start + name_size + fs_size > end:
+        return None, pos
+    f = FileEntry.__new__(FileEntry)
+    f._dirname = directories[directory_id]
+    f._name = buf[start:start+name_size].decode("utf-8")
+    start += name_size
+    f._fs_pathname = None
+    if flags & FileTreeEncoder.FLAG_FS_SAME:
+        f._fs_pathname = FileEntry._SAME_AS_PATHNAME
+    elif flags & FileTreeEncoder.FLAG_FS_PATHNAME:
+        f._fs_pathname = buf[start:start+fs_size].decode("utf-8")
+    start += fs_size
+    f.isdir = bool(flags & FileTreeEncoder.FLAG_ISDIR)
+    f.size = size
+    f.ctime = ctime if flags & FileTreeEncoder.FLAG_CTIME else None
+    f.mtime = mtime
+    f.mode = None
+    if flags & FileTreeEncoder.FLAG_MODE:
+        f.mode = FileEntry._modes.setdefault(mode, mode)
+    f.digest = digest
+    f.salt = salt
+    f.tree_digest = tree_digest
+    f.fingerprint = fingerprint
+    f.inode = None
+    if inode is not None:
+        f.inode = _INODE.unpack(inode)[0]
+    return f, start
+
+
+class FileTreeDecoder(object):
+    """
+        File-like object consuming the output of Crypto.decrypt_fd or
+        decompress_fd, the file tree is built while the data is written, trees
+        saved as JSON by older versions are also accepted.
+    """
+
+    def __init__(self):
+        self.tree = FileTree()
+        self.metadata = {}
+        self._buffer = bytearray()
+        self._json = None
+        self._started = False
+        self._finished = False
+        self._error = None
+        self._directories = []
+
+    def write(self, data):
+        if self._error is not None or self._finished:
+            return
+        if self._json is not None:
+            self._json.append(data)
+            return
+        self._buffer.extend(data)
+        if not self._started:
+            if len(self._buffer) < 5:
+                return
+            if bytes(self._buffer[:4]) != FileTreeEncoder.MAGIC:
+                self._json = [bytes(self._buffer)]
+                return
+            version = self._buffer[4]
+            if version > FileTreeEncoder.VERSION:
+                self._error = "Unrecognized file tree version: %d" % version
+                return
+            self._started = True
+            del self._buffer[:5]
+        try:
+            pos = self._parse()
+        except (ValueError, IndexError, UnicodeDecodeError) as e:
+            self._error = unicode_text(e)
+            return
+        del self._buffer[:pos]
+
+    def close(self):
+        """Check the whole tree has been received, raise InvalidFileTreeData
+        if not"""
+        if self._json is not None:
+            try:
+                d = json.loads(b''.join(self._json).decode("utf-8"))
+            except ValueError as e:
+                raise InvalidFileTreeData(unicode_text(e))
+            self.tree = FileTree.from_dict(d)
+            del d['table']
+            self.metadata = d
+            return
+        if self._error is not None:
+            raise InvalidFileTreeData(self._error)
+        if not self._finished:
+            raise InvalidFileTreeData("File tree data is truncated")
+
+    def _parse(self):
+        buf = self._buffer
+        end = len(buf)
+        pos = 0
+        record_header = FileTreeEncoder.RECORD_HEADER
+        directories = self._directories
+        tree = self.tree
+        while pos < end:
+            record_type = buf[pos]
+            if record_type == FileTreeEncoder.ENTRY:
+                f, pos = _decode_entry(buf, pos, end, directories)
+                if f is None:
+                    break
+                tree._insert(f._dirname, f._name, f)
+            elif record_type == FileTreeEncoder.DIRECTORY or \
+                    record_type == FileTreeEncoder.META:
+                if pos + record_header.size > end:
+                    break
+                (record_type, length) = record_header.unpack_from(buf, pos)
+                start = pos + record_header.size
+                if start + length > end:
+                    break
+                data = buf[start:start+length].decode("utf-8")
+                if record_type == FileTreeEncoder.META:
+                    self.metadata = json.loads(data)
+                else:
+                    directories.append(intern_text(data))
+                pos = start + length
+            elif record_type == FileTreeEncoder.STATS:
+                body = FileTreeEncoder.STATS_BODY
+                start = pos + record_header.size + body.size
+                if start > end:
+                    break
+                length = record_header.unpack_from(buf, pos)[1]
+                if start + length > end:
+                    break
+                size, files, mtime, has_mtime = body.unpack_from(
+                    buf, pos + record_header.size)
+                # all the entries come before, the aggregates stay valid
+                tree._stats[intern_text(buf[start:start+length].decode(
+                    "utf-8"))] = TreeStats(size, files,
+                                           mtime if has_mtime else None)
+                pos = start + length
+            elif record_type == FileTreeEncoder.END:
+                self._finished = True
+                return end
+            else:
+                raise ValueError("Unknown record type: %d" % record_type)
+        return pos
+
+
+class FileTreeIndex(object):
+    """
+        Read-only file tree mapped from a file sorted by pathname, lookups are
+        binary searches and entries are only decoded when they are requested.
+
+            +--------------------------------------------------------+
+            | Magic(4) | Version(1) | count(8) | table offset(8) |    |
+            | metadata length(4) | metadata in JSON                  |
+            +--------------------------------------------------------+
+            | key length(2) | key | entry record (see FileTreeEncoder)|
+            |                          ...                           |
+            +--------------------------------------------------------+
+            |              record offsets(8 * count)                 |
+            +--------------------------------------------------------+
+
+        The key is the UTF-8 pathname with '/' replaced by '\\0', so the
+        order of the keys is the order of FileTree.sorted_items().
+    """
+
+    MAGIC = b'\x00SFI'
+
+    VERSION = 0x4
+
+    HEADER = Struct(b'!4sBQQI')
+    KEY_LENGTH = Struct(b'!H')
+    OFFSET = Struct(b'!Q')
+
+    def __init__(self, path):
+        self._fp = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._fp.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            self._fp.close()
+            raise
+        header_size = self.HEADER.size
+        if len(self._map) < header_size:
+            self.close()
+            raise InvalidFileTreeData("File tree index is truncated")
+        (magic, version, self._count, self._table_offset,
+         meta_size) = self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC or version > self.VERSION or \
+                self._table_offset + self._count * self.OFFSET.size > \
+                len(self._map):
+            self.close()
+            raise InvalidFileTreeData("Invalid file tree index: " + path)
+        self.metadata = json.loads(
+            self._map[header_size:header_size+meta_size].decode("utf-8"))
+
+    @classmethod
+    def is_index(cls, path):
+        with open(path, 'rb') as f:
+            return f.read(len(cls.MAGIC)) == cls.MAGIC
+
+    @classmethod
+    def write(cls, path, file_tree, metadata=None):
+        """Write file_tree as an index, the file is replaced atomically"""
+        tmp_path = path + ".tmp"
+        meta = json.dumps(metadata or {}).encode("utf-8")
+        offsets = []
+        with open(tmp_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, 0, 0, len(meta)))
+            f.write(meta)
+            offset = cls.HEADER.size + len(meta)
+            for pathname, entry in file_tree.sorted_items():
+                key = pathname.encode("utf-8").replace(b'/', b'\x00')
+                record = cls.KEY_LENGTH.pack(len(key)) + key + \
+                    FileTreeEncoder._entry_record(0, entry._name, entry)
+                f.write(record)
+                offsets.append(offset)
+                offset += len(record)
+            for i in range(0, len(offsets), 8192):
+                f.write(b''.join([cls.OFFSET.pack(o)
+                                  for o in offsets[i:i+8192]]))
+            f.seek(0)
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(offsets),
+                                    offset, len(meta)))
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(tmp_path, path)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._fp.close()
+
+    def __len__(self):
+        return self._count
+
+    def _offset(self, i):
+        return self.OFFSET.unpack_from(
+            self._map, self._table_offset + i * self.OFFSET.size)[0]
+
+    def _key(self, offset):
+        (size,) = self.KEY_LENGTH.unpack_from(self._map, offset)
+        start = offset + self.KEY_LENGTH.size
+        return self._map[start:start+size]
+
+    def _entry(self, offset, key):
+        pos = key.rfind(b'\x00')
+        dirname = ''
+        if pos >= 0:
+            dirname = intern_text(
+                key[:pos].replace(b'\x00', b'/').decode("utf-8"))
+        start = offset + self.KEY_LENGTH.size + len(key)
+        f, end = _decode_entry(self._map, start, len(self._map), [dirname])
+        if f is None:
+            raise InvalidFileTreeData("File tree index is truncated")
+        return f
+
+    def _lower_bound(self, key):
+        """Position of the first key not less than key"""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(self._offset(middle)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get(self, pathname):
+        key = pathname.encode("utf-8").replace(b'/', b'\x00')
+        i = self._lower_bound(key)
+        if i < self._count:
+            offset = self._offset(i)
+            if self._key(offset) == key:
+                return self._entry(offset, key)
+        return None
+
+    def names(self, dirname):
+        """Names of the entries directly in the directory dirname, the
+        contents of child directories are passed over with a binary search"""
+        prefix = b''
+        if dirname != '':
+            prefix = dirname.encode("utf-8").replace(b'/', b'\x00') + \
+                b'\x00'
+        size = len(prefix)
+        names = []
+        i = self._lower_bound(prefix)
+        while i < self._count:
+            key = self._key(self._offset(i))
+            if not key.startswith(prefix):
+                break
+            pos = key.find(b'\x00', size)
+            if pos < 0:
+                names.append(key[size:].decode("utf-8"))
+                i += 1
+                continue
+            name = key[size:pos]
+            if not names or names[-1] != name.decode("utf-8"):
+                names.append(name.decode("utf-8"))
+            i = self._lower_bound(key[:pos] + b'\x01')
+        return names
+
+    def has(self, pathname):
+        return self.get(pathname) is not None
+
+    def sorted_items(self, prune=None):
+        """See FileTree.sorted_items, a pruned directory is passed over with
+        a binary search"""
+        i = 0
+        while i < self._count:
+            offset = self._offset(i)
+            key = self._key(offset)
+            f = self._entry(offset, key)
+            yield f.pathname, f
+            if prune is not None and prune(f.pathname, f):
+                i = self._lower_bound(key + b'\x01')
+            else:
+                i += 1
+
+    items = sorted_items
+
+    def pathnames(self):
+        return [pathname for pathname, f in self.items()]
+
+    def __str__(self):
+        s = ""
+        for pathname, item in self.items():
+            s += unicode_text(item)+"\n"
+        return s
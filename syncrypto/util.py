@@ -18,8 +18,11 @@
 from __future__ import unicode_literals
 import sys
 import os
+import mmap
 import hashlib
 import binascii
+import threading
+from struct import pack
 from getpass import getpass as builtin_getpass
 
 py3 = sys.version_info[0] == 3
@@ -28,6 +31,10 @@ py2_6 = (py2 and sys.version_info[1] == 6)
 is_windows = os.name == "nt"
 fs_encoding = sys.getfilesystemencoding()
 
+# files are written under their path with this suffix and then moved over,
+# they are never synchronized
+TMP_SUFFIX = ".syncrypto-tmp"
+
 if py3:
 
     def unicode_text(s, encoding="utf-8"):
@@ -49,6 +56,8 @@ if py3:
     def command_encoded(s):
         return s
 
+    intern_text = sys.intern
+
 else:
 
     def unicode_text(s, encoding="utf-8"):
@@ -73,18 +82,120 @@ else:
     def command_encoded(s):
         return s.encode(fs_encoding)
 
-
-def file_digest(path, buffer_size=10240):
-    md5_obj = hashlib.md5()
-    with open(path, 'rb') as f:
+    _interned_texts = {}
+
+    def intern_text(s):
+        # builtin intern() does not accept unicode in python 2
+        return _interned_texts.setdefault(s, s)
+
+
+def _digest_algorithms():
+    algorithms = []
+    for algorithm in ('md5', 'sha256', 'blake2b'):
+        try:
+            hashlib.new(algorithm)
+        except ValueError:
+            continue
+        algorithms.append(algorithm)
+    return algorithms
+
+
+# algorithms file_digest supports here, their digest sizes all differ
+DIGEST_ALGORITHMS = _digest_algorithms()
+
+_DIGEST_SIZES = {16: 'md5', 32: 'sha256', 64: 'blake2b'}
+
+# files from this size on are hashed from a memory map
+MMAP_DIGEST_SIZE = 16 << 20
+
+# read buffer of each thread hashing files
+_digest_buffers = threading.local()
+
+
+def digest_algorithm(digest):
+    """Name of the algorithm which produced digest, known by its size, or
+    None when it is not known"""
+    if digest is None:
+        return None
+    return _DIGEST_SIZES.get(len(digest))
+
+
+def file_digest(path, algorithm='md5', buffer_size=1 << 20):
+    hash_obj = hashlib.new(algorithm)
+    with open(path, 'rb', 0) as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_DIGEST_SIZE:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                data = None
+            if data is not None:
+                try:
+                    hash_obj.update(data)
+                finally:
+                    data.close()
+                return hash_obj.digest()
+        if py2_6:
+            while True:
+                data = f.read(buffer_size)
+                if len(data) <= 0:
+                    break
+                hash_obj.update(data)
+            return hash_obj.digest()
+        buf = getattr(_digest_buffers, 'buffer', None)
+        if buf is None or len(buf) != buffer_size:
+            buf = _digest_buffers.buffer = bytearray(buffer_size)
+        view = memoryview(buf)
         while True:
-            data = f.read(buffer_size)
-            if len(data) <= 0:
+            n = f.readinto(buf)
+            if not n:
                 break
-            md5_obj.update(data)
+            hash_obj.update(view[:n])
+    return hash_obj.digest()
+
+
+def file_fingerprint(path, size, block_size=4096, blocks=16):
+    """MD5 of the size and of blocks at the head, the tail and evenly spaced
+    offsets of a file, at most blocks * block_size bytes are read"""
+    md5_obj = hashlib.md5(pack(b'!Q', size))
+    with open(path, 'rb') as f:
+        if size <= block_size * blocks:
+            md5_obj.update(f.read(size))
+        else:
+            for i in range(blocks):
+                f.seek(i * (size - block_size) // (blocks - 1))
+                md5_obj.update(f.read(block_size))
     return md5_obj.digest()
 
 
+def parse_size(value):
+    """Number of bytes in a size like 1024, 10k, 100m or 2g"""
+    value = unicode_text(value).lower()
+    unit = value[-1]
+    if unit == 'g':
+        return int(value[:-1]) << 30
+    elif unit == 'm':
+        return int(value[:-1]) << 20
+    elif unit == 'k':
+        return int(value[:-1]) << 10
+    return int(value)
+
+
+def positive_int(value):
+    """An integer of at least 1, for options counting something"""
+    value = int(value)
+    if value < 1:
+        raise ValueError("%d is not a positive integer" % value)
+    return value
+
+
+def positive_size(value):
+    """A size of at least 1 byte, see parse_size"""
+    value = parse_size(value)
+    if value < 1:
+        raise ValueError("%d is not a positive size" % value)
+    return value
+
+
 def string_digest(string, encoding="utf-8"):
     md5_obj = hashlib.md5()
     md5_obj.update(string.encode(encoding))
@@ -99,6 +210,39 @@ def file_hexlify_digest(path):
     return hexlify(file_digest(path))
 
 
+def replace_file(src, dst):
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # python 2 has no os.replace and os.rename does not overwrite on
+        # windows
+        if is_windows and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def fsync_path(path):
+    # windows flushes only the files opened for writing
+    fd = os.open(path, os.O_RDWR if is_windows else os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_paths(paths):
+    """Make the files at paths and their names durable, each file and then
+    each folder holding them is flushed once"""
+    dirnames = set()
+    for path in paths:
+        if os.path.exists(path):
+            fsync_path(path)
+            dirnames.add(os.path.dirname(path))
+    if not is_windows:
+        for dirname in dirnames:
+            fsync_path(dirname)
+
+
 def getpass(text="password:"):
     if is_windows and py2:
         text = text.encode("utf8")
@@ -513,6 +513,69 @@ class CliTestCase(unittest.TestCase):
         self.assertEqual(sorted(cmp_result.right_only),
                          ["files.conflict.txt"])
 
+    def test_conflict_folder(self):
+        self.clear_folders()
+        prepare_filetree(self.plain_folder, '''
+            item: file
+            other/item/inner: 1
+        ''')
+        prepare_filetree(self.plain_folder_check, '''
+            item/inner: folder
+            item.txt: 2
+            other/item: file
+        ''')
+        self.cli(["--password-file", self.password_file, self.encrypted_folder,
+                  self.plain_folder])
+        self.cli(["--password-file", self.password_file, self.encrypted_folder,
+                  self.plain_folder_check])
+        cmp_result = self.tree_cmp(self.plain_folder, self.plain_folder_check)
+        self.assertEqual(cmp_result.left_only, [])
+        self.assertEqual(sorted(cmp_result.right_only),
+                         ["item.conflict", "item.conflict/inner", "item.txt",
+                          "other/item.conflict"])
+        self.assertEqual(cmp_result.diff_files, [])
+        self.assertEqual(open(os.path.join(self.plain_folder_check,
+                                           "item.conflict", "inner")).read(),
+                         "folder")
+        self.cli(["--password-file", self.password_file, self.encrypted_folder,
+                  self.plain_folder_check])
+        self.cli(["--password-file", self.password_file, self.encrypted_folder,
+                  self.plain_folder])
+        cmp_result = self.tree_cmp(self.plain_folder, self.plain_folder_check)
+        self.assertEqual(cmp_result.left_only, [])
+        self.assertEqual(cmp_result.right_only, [])
+
+    def test_stats(self):
+        self.clear_folders()
+        prepare_filetree(self.plain_folder, '''
+            a/b: 12
+            a/c: 345
+        ''')
+        self.assertEqual(syncrypto_cli(["--password-file", self.password_file,
+                                        self.encrypted_folder, "--stats"]), 1)
+        self.cli(["--password-file", self.password_file, self.encrypted_folder,
+                  self.plain_folder])
+        self.cli(["--password-file", self.password_file, self.encrypted_folder,
+                  "--stats"])
+        self.cli(["--password-file", self.password_file, "--stats", "a",
+                  self.encrypted_folder])
+        self.assertEqual(syncrypto_cli(["--password-file", self.password_file,
+                                        "--stats", "d",
+                                        self.encrypted_folder]), 1)
+
+    def test_dry_run(self):
+        self.clear_folders()
+        prepare_filetree(self.plain_folder, '''
+            a/b: 12
+        ''')
+        self.cli(["--password-file", self.password_file, "--dry-run",
+                  self.encrypted_folder, self.plain_folder])
+        self.assertEqual(os.listdir(self.encrypted_folder), ["_syncrypto"])
+        # a single plan, not synchronized every interval
+        self.cli(["--password-file", self.password_file, "--dry-run",
+                  "--interval", "1", self.encrypted_folder, self.plain_folder])
+        self.assertEqual(os.listdir(self.encrypted_folder), ["_syncrypto"])
+
     def test_encrypt_file_no_out_file(self):
         self.clear_folders()
         prepare_filetree(self.plain_folder, '''
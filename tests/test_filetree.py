@@ -18,14 +18,20 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 import unittest
+import hashlib
 import os
 import os.path
 import shutil
 from tempfile import mkstemp, mkdtemp
 from syncrypto import FileEntry, FileTree, FileRuleSet
+from syncrypto.filetree import FileTreeEncoder, FileTreeDecoder, \
+    FileTreeIndex, InvalidFileTreeData, merge_sorted_items
+import json
 from time import time
 from util import prepare_filetree, clear_folder
-from syncrypto.util import file_hexlify_digest, file_digest, hexlify, is_windows
+from syncrypto import util
+from syncrypto.util import file_hexlify_digest, file_digest, hexlify, \
+    is_windows, digest_algorithm, DIGEST_ALGORITHMS
 
 
 try:
@@ -84,9 +90,54 @@ class FileEntryTestCase(unittest.TestCase):
         }
         if is_windows:
             d['mode'] = None
+        if stat.st_ino:
+            d['inode'] = stat.st_ino
         file_object = FileEntry.from_file(self.file_path, d['pathname'])
         self.assertEqual(d, file_object.to_dict())
 
+    def test_digest_algorithms(self):
+        with open(self.file_path, "wb") as f:
+            f.write(b"a" * 100000)
+        for algorithm in DIGEST_ALGORITHMS:
+            expected = hashlib.new(algorithm, b"a" * 100000).digest()
+            self.assertEqual(file_digest(self.file_path, algorithm), expected)
+            self.assertEqual(digest_algorithm(expected), algorithm)
+            mmap_digest_size = util.MMAP_DIGEST_SIZE
+            util.MMAP_DIGEST_SIZE = 1000
+            try:
+                self.assertEqual(file_digest(self.file_path, algorithm),
+                                 expected)
+            finally:
+                util.MMAP_DIGEST_SIZE = mmap_digest_size
+        entry = FileEntry.from_file(self.file_path, "a")
+        self.assertEqual(entry.digest, None)
+        with open(self.file_path, "wb") as f:
+            f.write(b"a")
+        entry = FileEntry.from_file(self.file_path, "a",
+                                    digest_algorithm='sha256')
+        self.assertEqual(entry.digest, hashlib.sha256(b"a").digest())
+        other = FileEntry.from_file(self.file_path, "a")
+        self.assertTrue(entry.same_content(other))
+        other.size = 2
+        self.assertFalse(entry.same_content(other))
+
+    def test_fingerprint(self):
+        path = self.file_path
+        with open(path, "wb") as f:
+            f.write(b"a" * 100000)
+        self.assertIsNone(FileEntry.from_file(path, "large").fingerprint)
+        self.assertIsNone(
+            FileEntry.from_file(path, "large", 100000).fingerprint)
+        fingerprint = FileEntry.from_file(path, "large", 1000).fingerprint
+        self.assertEqual(len(fingerprint), 16)
+        self.assertEqual(FileEntry.from_dict(FileEntry.from_file(
+            path, "large", 1000).to_dict()).fingerprint, fingerprint)
+        with open(path, "r+b") as f:
+            f.seek(99999)
+            f.write(b"b")
+        self.assertNotEqual(
+            FileEntry.from_file(path, "large", 1000).fingerprint, fingerprint)
+
     def test_from_dict(self):
         stat = os.stat(self.file_path)
         d = {
@@ -103,6 +154,10 @@ class FileEntryTestCase(unittest.TestCase):
         file_object = FileEntry(**d)
         d['digest'] = hexlify(d['digest'])
         self.assertEqual(d, file_object.to_dict())
+        file_object = FileEntry.from_dict(d)
+        self.assertEqual(d['digest'], hexlify(file_object.digest))
+        self.assertEqual(d, file_object.to_dict())
+        self.assertFalse(hasattr(file_object, '__dict__'))
 
 
 class FileTreeTestCase(unittest.TestCase):
@@ -131,6 +186,15 @@ class FileTreeTestCase(unittest.TestCase):
         self.assertEqual(filetree.get('1/2').isdir, False)
         self.assertEqual(len(filetree.files()), 3)
         self.assertEqual(len(filetree.folders()), 5)
+        self.assertEqual(filetree.count_files(), 3)
+        self.assertEqual(filetree.count_folders(), 5)
+        entry = filetree.get('b').clone()
+        entry.isdir = False
+        filetree.set('b', entry)
+        filetree.remove('c/d/e/f')
+        self.assertEqual(sorted([f.pathname for f in filetree.files()]),
+                         ['1/2', 'a', 'b'])
+        self.assertEqual(filetree.count_folders(), 4)
 
     def test_walk_tree_with_rule(self):
         clear_folder(self.directory_path)
@@ -147,6 +211,285 @@ class FileTreeTestCase(unittest.TestCase):
         self.assertEqual(len(filetree.files()), 3)
         self.assertEqual(len(filetree.folders()), 2)
 
+    def test_directory_table(self):
+        filetree = FileTree()
+        filetree.set('a/b/c', FileEntry('a/b/c', 1, 0, 0, None))
+        filetree.set('a/b/d', FileEntry('a/b/d', 1, 0, 0, None))
+        self.assertFalse(filetree.has('a'))
+        self.assertFalse(filetree.has('a/b'))
+        self.assertEqual(len(filetree), 2)
+        self.assertTrue(filetree.get('a/b/c').split()[0] is
+                        filetree.get('a/b/d').split()[0])
+        filetree.set('a', FileEntry('a', 0, 0, 0, None, isdir=True))
+        filetree.remove('a/b/c')
+        filetree.remove('a/b/d')
+        self.assertEqual(filetree.pathnames(), ['a'])
+        filetree.set('a/b', FileEntry('a/b', 1, 0, 0, None))
+        filetree.remove('a')
+        self.assertEqual(filetree.pathnames(), ['a/b'])
+        self.assertEqual(filetree.get('a/b').fs_pathname, None)
+
+    def test_tree_digests(self):
+        prepare_filetree(self.directory_path, '''
+            a/b/c:content
+            a/d
+            e/
+        ''')
+        filetree = FileTree.from_fs(self.directory_path)
+        filetree.update_tree_digests()
+        other = FileTree.from_dict(filetree.to_dict())
+        self.assertEqual(other.get('a').tree_digest,
+                         filetree.get('a').tree_digest)
+        other.update_tree_digests()
+        self.assertEqual(other.get('a').tree_digest,
+                         filetree.get('a').tree_digest)
+        self.assertNotEqual(filetree.get('a').tree_digest,
+                            filetree.get('a/b').tree_digest)
+        other.get('a/b/c').digest = b'0' * 16
+        other.update_tree_digests()
+        self.assertNotEqual(other.get('a').tree_digest,
+                            filetree.get('a').tree_digest)
+        self.assertNotEqual(other.get('a/b').tree_digest,
+                            filetree.get('a/b').tree_digest)
+        self.assertEqual(other.get('e').tree_digest,
+                         filetree.get('e').tree_digest)
+        self.assertEqual(
+            [pathname for pathname, _ in filetree.sorted_items(
+                lambda pathname, entry: pathname == 'a')], ['a', 'e'])
+
+    def test_binary_format(self):
+        prepare_filetree(self.directory_path, '''
+            a
+            b/
+            c/d/e/f:content
+            c/\u4e2d\u6587:unicode
+        ''')
+        filetree = FileTree.from_fs(self.directory_path)
+        filetree.get('a').fs_pathname = 'x1'
+        filetree.get('a').salt = b'salt'
+        filetree.get('b').mode = None
+        filetree.get('b').inode = None
+        filetree.get('c/d/e/f').fingerprint = b'fingerprint'
+        filetree.update_tree_digests()
+        encoder = FileTreeEncoder(filetree, {'key': 'value'})
+        decoder = FileTreeDecoder()
+        while True:
+            data = encoder.read(7)
+            if not data:
+                break
+            decoder.write(data)
+        decoder.close()
+        self.assertEqual(decoder.metadata, {'key': 'value'})
+        self.assertEqual(decoder.tree.to_dict(), filetree.to_dict())
+
+        decoder = FileTreeDecoder()
+        decoder.write(FileTreeEncoder(filetree).read()[:-1])
+        self.assertRaises(InvalidFileTreeData, decoder.close)
+
+    def test_decode_json(self):
+        prepare_filetree(self.directory_path, '''
+            a
+            c/d:content
+        ''')
+        filetree = FileTree.from_fs(self.directory_path)
+        d = filetree.to_dict()
+        d['trash_name'] = 'trash'
+        decoder = FileTreeDecoder()
+        decoder.write(json.dumps(d).encode('utf-8'))
+        decoder.close()
+        self.assertEqual(decoder.metadata, {'trash_name': 'trash'})
+        self.assertEqual(decoder.tree.to_dict(), filetree.to_dict())
+
+    def test_index(self):
+        prepare_filetree(self.directory_path, '''
+            a
+            a.b
+            a0/b
+            b/
+            c/d/e/f:content
+            c/d/e.txt:content
+        ''')
+        filetree = FileTree.from_fs(self.directory_path)
+        index_path = os.path.join(self.directory_path, 'index')
+        FileTreeIndex.write(index_path, filetree, {'key': 'value'})
+        self.assertTrue(FileTreeIndex.is_index(index_path))
+        index = FileTreeIndex(index_path)
+        try:
+            self.assertEqual(index.metadata, {'key': 'value'})
+            self.assertEqual(len(index), len(filetree))
+            self.assertEqual(index.pathnames(),
+                             [p for p, f in filetree.sorted_items()])
+            self.assertEqual(index.pathnames()[:4],
+                             ['a', 'a.b', 'a0', 'a0/b'])
+            for pathname, f in filetree.items():
+                self.assertEqual(index.get(pathname).to_dict(), f.to_dict())
+            self.assertEqual(index.get('c/d/e'+'\u4e2d'), None)
+            self.assertEqual(index.get('0'), None)
+            self.assertEqual(index.get('z'), None)
+            for dirname in ['', 'a0', 'b', 'c', 'c/d', 'c/d/e', 'z']:
+                self.assertEqual(sorted(index.names(dirname)),
+                                 sorted(filetree.names(dirname)))
+        finally:
+            index.close()
+
+    def test_prefix_operations(self):
+        filetree = FileTree()
+        for pathname in ['a', 'a/b', 'a/b/c', 'a/d', 'ab', 'e/f']:
+            filetree.set(pathname, FileEntry(pathname, 1, 0, 0, None,
+                                             isdir=pathname in ('a', 'a/b'),
+                                             fs_pathname=pathname))
+        filetree.get('a/d').fs_pathname = 'x'
+        self.assertEqual([p for p, f in filetree.iter_prefix('a')],
+                         ['a', 'a/b', 'a/b/c', 'a/d'])
+        self.assertEqual([p for p, f in filetree.iter_prefix('e')], ['e/f'])
+        filetree.move_prefix('a', 'g/h')
+        self.assertEqual(sorted(filetree.pathnames()),
+                         ['ab', 'e/f', 'g/h', 'g/h/b', 'g/h/b/c', 'g/h/d'])
+        self.assertEqual(filetree.get('g/h/b/c').fs_pathname, 'g/h/b/c')
+        self.assertEqual(filetree.get('g/h/d').fs_pathname, 'x')
+        self.assertEqual(filetree.get_by_fs_pathname('x').pathname, 'g/h/d')
+        filetree.move_prefix('ab', 'ac', keep_fs_pathname=True)
+        self.assertEqual(filetree.get('ac').fs_pathname, 'ab')
+        filetree.move_prefix('ac', 'ab', keep_fs_pathname=True)
+        self.assertEqual(filetree.get('ab').fs_pathname, 'ab')
+        self.assertEqual(filetree.count_folders(), 2)
+        self.assertEqual(filetree.remove_prefix('g/h/b'), 2)
+        self.assertEqual(filetree.remove_prefix('g/h/b'), 0)
+        self.assertEqual(filetree.remove_prefix('e'), 1)
+        self.assertEqual(sorted(filetree.pathnames()), ['ab', 'g/h', 'g/h/d'])
+        self.assertEqual(len(filetree), 3)
+        self.assertEqual(filetree.count_folders(), 1)
+        self.assertEqual(filetree.remove_prefix('g/h'), 2)
+        self.assertEqual(filetree.names(''), ['ab'])
+
+    def test_stats(self):
+        filetree = FileTree()
+        filetree.set('a', FileEntry('a', 0, 0, 5, None, isdir=True))
+        filetree.set('a/b/c', FileEntry('a/b/c', 10, 0, 1, None))
+        filetree.set('a/d', FileEntry('a/d', 20, 0, 3, None))
+        filetree.set('e', FileEntry('e', 30, 0, 2, None))
+        self.assertEqual(tuple(filetree.stats()), (60, 3, 3))
+        self.assertEqual(tuple(filetree.stats('a')), (30, 2, 3))
+        self.assertEqual(tuple(filetree.stats('a/b')), (10, 1, 1))
+        self.assertEqual(tuple(filetree.stats('e')), (30, 1, 2))
+        self.assertEqual(filetree.stats('f'), None)
+        filetree.remove('a/d')
+        self.assertEqual(tuple(filetree.stats('a')), (10, 1, 1))
+        self.assertEqual(tuple(filetree.stats()), (40, 2, 2))
+        filetree.set('a/b/f', FileEntry('a/b/f', 1, 0, 9, None))
+        self.assertEqual(tuple(filetree.stats()), (41, 3, 9))
+        filetree.remove_prefix('a')
+        self.assertEqual(tuple(filetree.stats()), (30, 1, 2))
+        filetree.set('g', FileEntry('g', 0, 0, 0, None, isdir=True))
+        self.assertEqual(tuple(filetree.stats('g')), (0, 0, None))
+
+        decoder = FileTreeDecoder()
+        decoder.write(FileTreeEncoder(filetree).read())
+        decoder.close()
+        self.assertEqual(decoder.tree._stats, filetree._stats)
+        self.assertEqual(tuple(decoder.tree.stats()), (30, 1, 2))
+
+    def test_merge_sorted_items(self):
+        tree1 = FileTree.from_dict({'table': {
+            'a': FileEntry('a', 1, 0, 0, None).to_dict(),
+            'b': FileEntry('b', 0, 0, 0, None, isdir=True).to_dict(),
+            'b/c': FileEntry('b/c', 1, 0, 0, None).to_dict(),
+            'b.d': FileEntry('b.d', 1, 0, 0, None).to_dict(),
+        }})
+        tree2 = FileTree.from_dict({'table': {
+            'b': FileEntry('b', 0, 0, 0, None, isdir=True).to_dict(),
+            'b/a': FileEntry('b/a', 1, 0, 0, None).to_dict(),
+            'c': FileEntry('c', 1, 0, 0, None).to_dict(),
+        }})
+        merged = [(pathname, tuple(f is not None for f in entries))
+                  for pathname, entries in merge_sorted_items((tree1, tree2))]
+        self.assertEqual(merged, [('a', (True, False)),
+                                  ('b', (True, True)),
+                                  ('b/a', (False, True)),
+                                  ('b/c', (True, False)),
+                                  ('b.d', (True, False)),
+                                  ('c', (False, True))])
+        merged = [pathname for pathname, entries in merge_sorted_items(
+            (tree1, tree2), lambda pathname, entries: pathname == 'b')]
+        self.assertEqual(merged, ['a', 'b', 'b.d', 'c'])
+        tree1.set('b/b', FileEntry('b/b', 1, 0, 0, None))
+        self.assertEqual([pathname for pathname, f in tree1.sorted_items()],
+                         ['a', 'b', 'b/b', 'b/c', 'b.d'])
+
+    def test_diff(self):
+        old = FileTree()
+        old.set('a', FileEntry('a', 1, 0, 0, None))
+        old.set('b', FileEntry('b', 0, 0, 0, None, isdir=True))
+        old.set('b/c', FileEntry('b/c', 1, 0, 0, None))
+        old.set('d', FileEntry('d', 1, 0, 0, None))
+        old.set('e', FileEntry('e', 0, 0, 0, None, isdir=True))
+        old.set('e/f', FileEntry('e/f', 1, 0, 0, None))
+        new = FileTree()
+        new.set('a', FileEntry('a', 2, 0, 0, None))
+        new.set('b', FileEntry('b', 0, 0, 0, None, isdir=True))
+        new.set('b/c', FileEntry('b/c', 1, 0, 0, None))
+        new.set('b/g', FileEntry('b/g', 1, 0, 0, None))
+        new.set('d', FileEntry('d', 0, 0, 0, None, isdir=True))
+        new.set('e', FileEntry('e', 0, 0, 0, None, isdir=True))
+        new.set('e/f', FileEntry('e/f', 1, 0, 0, None))
+        changes = [(change.kind, change.pathname)
+                   for change in new.diff(old)]
+        self.assertEqual(changes, [('modified', 'a'), ('added', 'b/g'),
+                                   ('type changed', 'd')])
+        self.assertEqual([(change.kind, change.pathname)
+                          for change in old.diff(new)],
+                         [('modified', 'a'), ('removed', 'b/g'),
+                          ('type changed', 'd')])
+        change = next(new.diff(old))
+        self.assertEqual((change.old.size, change.new.size), (1, 2))
+
+        old.update_tree_digests()
+        new.update_tree_digests()
+        decoder = FileTreeDecoder()
+        decoder.write(FileTreeEncoder(old).read())
+        decoder.close()
+        self.assertEqual([(change.kind, change.pathname)
+                          for change in new.diff(decoder.tree)], changes)
+        self.assertEqual(list(new.diff(new)), [])
+
+    def test_from_fs_previous(self):
+        prepare_filetree(self.directory_path, '''
+            a/b
+            a/c/d
+        ''')
+        previous = FileTree.from_fs(self.directory_path)
+        dir_path = os.path.join(self.directory_path, 'a')
+        mtime = previous.get('a').mtime
+        prepare_filetree(self.directory_path, '''
+            a/e
+        ''')
+        os.utime(dir_path, (mtime, mtime))
+        filetree = FileTree.from_fs(self.directory_path, previous=previous)
+        self.assertEqual(sorted(filetree.pathnames()),
+                         ['a', 'a/b', 'a/c', 'a/c/d'])
+        os.utime(dir_path, (mtime - 10, mtime - 10))
+        filetree = FileTree.from_fs(self.directory_path, previous=previous)
+        self.assertEqual(sorted(filetree.pathnames()),
+                         ['a', 'a/b', 'a/c', 'a/c/d', 'a/e'])
+
+    def test_fs_pathname_index(self):
+        filetree = FileTree.from_dict({'table': {
+            'a': {'pathname': 'a', 'fs_pathname': 'x1', 'isdir': True,
+                  'size': 0, 'ctime': 0, 'mtime': 0, 'mode': None},
+        }})
+        self.assertTrue(filetree.has_fs_pathname('x1'))
+        entry = FileEntry('a/b', 1, 0, 0, None, fs_pathname='x1/y2')
+        filetree.set('a/b', entry)
+        self.assertTrue(filetree.has_fs_pathname('x1/y2'))
+        self.assertEqual(filetree.get_by_fs_pathname('x1/y2'), entry)
+        entry = FileEntry('a/b', 1, 0, 0, None, fs_pathname='x1/y3')
+        filetree.set('a/b', entry)
+        self.assertFalse(filetree.has_fs_pathname('x1/y2'))
+        self.assertTrue(filetree.has_fs_pathname('x1/y3'))
+        filetree.remove('a/b')
+        self.assertFalse(filetree.has_fs_pathname('x1/y3'))
+        self.assertEqual(filetree.get_by_fs_pathname('x1/y3'), None)
+
 
 if __name__ == '__main__':
     unittest.main()
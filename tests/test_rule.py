@@ -220,5 +220,63 @@ class FileRuleSetTestCase(unittest.TestCase):
         self.assertEqual(f.test(self.file_entry), None)
         self.file_entry.pathname = tmp
 
+    def test_merged_rules_keep_order(self):
+        rule_set = FileRuleSet()
+        rule_set.add_rule_by_string("include: name eq keep.pyc")
+        rule_set.add_rule_by_string("exclude: name match *.pyc")
+        rule_set.add_rule_by_string("exclude: name regexp .*\\.swp")
+        rule_set.add_rule_by_string("include: path match build/*")
+        rule_set.add_rule_by_string("exclude: name eq build")
+        self.assertEqual(rule_set.test_pathname("a/keep.pyc"), "include")
+        self.assertEqual(rule_set.test_pathname("a/b.pyc"), "exclude")
+        self.assertEqual(rule_set.test_pathname("a/.b.swp"), "exclude")
+        self.assertEqual(rule_set.test_pathname("build/build"), "include")
+        self.assertEqual(rule_set.test_pathname("a/build"), "exclude")
+        self.assertEqual(rule_set.test_pathname("a/b"), "include")
+
+    def test_pathname_needs_stat(self):
+        rule_set = FileRuleSet()
+        rule_set.add_rule_by_string("exclude: name eq .git")
+        rule_set.add_rule_by_string("exclude: size > 1024")
+        rule_set.add_rule_by_string("exclude: name match *.tmp")
+        self.assertEqual(rule_set.test_pathname("a/.git"), "exclude")
+        self.assertEqual(rule_set.test_pathname("a/b.tmp"), None)
+        self.file_entry.size = 2048
+        self.assertEqual(rule_set.test(self.file_entry), "exclude")
+        self.file_entry.size = 0
+        self.assertEqual(rule_set.test(self.file_entry), "include")
+
+    def test_name_decisions_are_cached(self):
+        rule_set = FileRuleSet()
+        rule_set.add_rule_by_string("exclude: name match *.pyc")
+        rule_set.add_rule_by_string("include: path eq a/b")
+        rule_set.add_rule_by_string("exclude: name eq b")
+        for i in range(2):
+            self.assertEqual(rule_set.test_pathname("a/x.pyc"), "exclude")
+            self.assertEqual(rule_set.test_pathname("a/b"), "include")
+            self.assertEqual(rule_set.test_pathname("c/b"), "exclude")
+            self.assertEqual(rule_set.test_pathname("c/d"), "include")
+        rule_set.add_rule_by_string("exclude: name eq d")
+        self.assertEqual(rule_set.test_pathname("c/d"), "exclude")
+
+    def test_compiled_rules_match_each_rule(self):
+        rules = ["exclude: name ne x", "include: path regexp (a|b)/.*",
+                 "exclude: size < 1k", "ignore: name match [ab]*"]
+        rule_set = FileRuleSet()
+        for rule_string in rules:
+            rule_set.add_rule_by_string(rule_string)
+        for pathname in ["x", "a/x", "b/y", "c/x", "ab"]:
+            for size in [0, 2048]:
+                self.file_entry.pathname = pathname
+                self.file_entry.size = size
+                expected = rule_set.default_action
+                for rule_string in rules:
+                    action = FileRuleSet.parse(rule_string).test(
+                        self.file_entry)
+                    if action is not None:
+                        expected = action
+                        break
+                self.assertEqual(rule_set.test(self.file_entry), expected)
+
 if __name__ == '__main__':
     unittest.main()
@@ -22,8 +22,11 @@ import unittest
 import os
 import os.path
 import shutil
+import signal
 from tempfile import mkdtemp
-from syncrypto import FileTree, Crypto, Syncrypto, InvalidFolder
+from syncrypto import FileTree, Crypto, Syncrypto, InvalidFolder, \
+    SyncInterrupted
+from syncrypto import core
 from filecmp import dircmp
 from syncrypto.crypto import DecryptError
 from util import clear_folder, prepare_filetree
@@ -157,6 +160,444 @@ class SyncTestCase(unittest.TestCase):
         self.plain_tree = FileTree.from_fs(self.plain_folder)
         self.isPass()
 
+    def test_is_unchanged(self):
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder,
+                         self.encrypted_tree, self.plain_tree,
+                         self.snapshot_tree)
+        sync.sync_folder(False)
+        self.assertTrue(sync.encrypted_tree.get("dir2").tree_digest
+                        is not None)
+        self.assertEqual(sync.encrypted_tree.get("dir2").tree_digest,
+                         sync.plain_tree.get("dir2").tree_digest)
+        sync.rule_set.add_rule_by_string("exclude: name eq file2")
+
+        def is_unchanged(pathname):
+            return sync._is_unchanged(sync.plain_tree.get(pathname),
+                                      sync.encrypted_tree.get(pathname))
+        self.assertTrue(is_unchanged("sync_file_modify"))
+        self.assertTrue(is_unchanged("dir2"))
+        self.assertFalse(is_unchanged("dir2/file2"))
+        sync.plain_tree.get("sync_file_modify").digest = b"0" * 16
+        self.assertFalse(is_unchanged("sync_file_modify"))
+
+    def test_fast_scan(self):
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder,
+                         fast_scan=True)
+        sync.sync_folder()
+        sync.sync_folder()
+        sync._load_snapshot_tree()
+        self.assertEqual(sync.snapshot_tree.get("dir2").mtime,
+                         os.stat(os.path.join(self.plain_folder,
+                                              "dir2")).st_mtime)
+        sync._close_snapshot_tree()
+        prepare_filetree(self.plain_folder, '''
+            dir2/file3
+        ''')
+        sync.sync_folder()
+        self.assertTrue(sync.encrypted_tree.has("dir2/file3"))
+        sync2 = Syncrypto(self.crypto, self.encrypted_folder,
+                          self.plain_folder_check)
+        sync2.sync_folder()
+        directory_cmp = dircmp(os.path.join(self.plain_folder, "dir2"),
+                               os.path.join(self.plain_folder_check, "dir2"))
+        self.assertEqual(directory_cmp.left_only, [])
+        # the folder mtimes of a fast scan are not shared
+        prepare_filetree(self.plain_folder_check, '''
+            dir2/file4
+        ''')
+        sync2.sync_folder()
+        sync.sync_folder()
+        self.assertTrue(os.path.exists(
+            os.path.join(self.plain_folder, "dir2", "file4")))
+        self.assertNotEqual(sync.encrypted_tree.get("dir2").mtime, 0)
+        plain_folder_new = mkdtemp()
+        try:
+            Syncrypto(self.crypto, self.encrypted_folder,
+                      plain_folder_new).sync_folder()
+            self.assertNotEqual(
+                os.stat(os.path.join(plain_folder_new, "dir2")).st_mtime, 0)
+        finally:
+            shutil.rmtree(plain_folder_new)
+
+    def test_fast_scan_file_made_during_sync(self):
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder,
+                         fast_scan=True)
+        sync.sync_folder()
+        load_plain_tree = sync._load_plain_tree
+
+        def load_and_make_file():
+            load_plain_tree()
+            prepare_filetree(self.plain_folder, '''
+                dir2/late
+            ''')
+        sync._load_plain_tree = load_and_make_file
+        sync.sync_folder()
+        self.assertFalse(sync.encrypted_tree.has("dir2/late"))
+        sync._load_plain_tree = load_plain_tree
+        sync.sync_folder()
+        self.assertTrue(sync.encrypted_tree.has("dir2/late"))
+
+    def test_verify_content(self):
+        path = os.path.join(self.plain_folder, "large")
+        with open(path, "wb") as f:
+            f.write(b"a" * 20000)
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder,
+                         verify_content=True)
+        sync.sync_folder()
+        encrypted_path = sync.encrypted_tree.get("large").fs_path(
+            self.encrypted_folder)
+        with open(encrypted_path, "rb") as f:
+            encrypted_content = f.read()
+        mtime = os.stat(path).st_mtime
+        os.utime(path, (mtime + 10, mtime + 10))
+        sync.sync_folder()
+        with open(encrypted_path, "rb") as f:
+            self.assertEqual(f.read(), encrypted_content)
+        self.assertEqual(int(os.stat(path).st_mtime), int(mtime + 10))
+        sync._load_snapshot_tree()
+        self.assertEqual(int(sync.snapshot_tree.get("large").mtime),
+                         int(mtime + 10))
+        self.assertEqual(int(sync.encrypted_tree.get("large").mtime),
+                         int(mtime))
+        sync._close_snapshot_tree()
+        # not hashed again, with or without verify content
+        hashed = []
+
+        def count_digest(args):
+            hashed.append(args[0])
+            return try_file_digest(args)
+        try_file_digest = core._try_file_digest
+        core._try_file_digest = count_digest
+        try:
+            for i in range(3):
+                sync.sync_folder()
+            Syncrypto(self.crypto, self.encrypted_folder,
+                      self.plain_folder).sync_folder()
+            sync.sync_folder()
+        finally:
+            core._try_file_digest = try_file_digest
+        self.assertEqual(hashed, [])
+        with open(encrypted_path, "rb") as f:
+            self.assertEqual(f.read(), encrypted_content)
+        with open(path, "wb") as f:
+            f.write(b"b" * 20000)
+        os.utime(path, (mtime + 20, mtime + 20))
+        sync.sync_folder()
+        with open(encrypted_path, "rb") as f:
+            self.assertNotEqual(f.read(), encrypted_content)
+
+    def test_digest_algorithm(self):
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder,
+                         digest_algorithm='sha256')
+        sync.sync_folder()
+        for f in sync.encrypted_tree.files():
+            if not f.isdir:
+                self.assertEqual(len(f.digest), 32)
+        self.assertEqual(sync.snapshot_tree.get("dir2/file2").digest,
+                         sync.encrypted_tree.get("dir2/file2").digest)
+        encrypted_path = sync.encrypted_tree.get("dir2/file2").fs_path(
+            self.encrypted_folder)
+        mtime = os.stat(encrypted_path).st_mtime
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder)
+        sync.sync_folder()
+        self.assertEqual(os.stat(encrypted_path).st_mtime, mtime)
+        self.assertEqual(len(sync.encrypted_tree.get("dir2/file2").digest),
+                         16)
+        sync2 = Syncrypto(self.crypto, self.encrypted_folder,
+                          self.plain_folder_check)
+        sync2.sync_folder()
+        directory_cmp = dircmp(self.plain_folder, self.plain_folder_check)
+        self.assertEqual(directory_cmp.diff_files, [])
+
+    def test_dry_run(self):
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder)
+        plan = sync.sync_folder(dry_run=True)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.encrypted_folder, "_syncrypto", "filetree")))
+        self.assertEqual(set(item.action for item in plan), set(["encrypt"]))
+        sync.sync_folder()
+        prepare_filetree(self.plain_folder, '''
+            sync_file_modify:hello world!
+            new_file:new
+        ''')
+        os.remove(os.path.join(self.plain_folder, "sync_file_delete"))
+        plan = sync.sync_folder(dry_run=True)
+        self.assertEqual([(item.action, item.pathname) for item in plan],
+                         [("encrypt", "new_file"),
+                          ("remove encrypted", "sync_file_delete"),
+                          ("encrypt", "sync_file_modify")])
+        self.assertEqual(plan.totals(), {"encrypt": (2, 15, 15),
+                                         "remove encrypted": (1, 0, 0)})
+        self.assertTrue(str(plan).endswith(
+            "total: 3 pathnames, 15 bytes to read, 15 bytes to write"))
+        self.assertTrue(sync.encrypted_tree.has("sync_file_delete"))
+        sync.sync_folder()
+        self.assertFalse(sync.encrypted_tree.has("sync_file_delete"))
+        self.assertEqual(len(sync.sync_folder(dry_run=True)), 0)
+
+    def test_atomic_write(self):
+        prepare_filetree(self.plain_folder, '''
+            stale.syncrypto-tmp:half written
+        ''')
+        # a rules file without the default rules
+        prepare_filetree(self.plain_folder, '''
+            .syncrypto/rules:ignore: name eq .git
+        ''')
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder)
+        sync.sync_folder()
+        self.assertFalse(sync.encrypted_tree.has("stale.syncrypto-tmp"))
+        encrypted_file = sync.encrypted_tree.get("sync_file_modify")
+        encrypted_path = encrypted_file.fs_path(self.encrypted_folder)
+        prepare_filetree(self.plain_folder, '''
+            sync_file_modify:hello world!
+        ''')
+
+        def broken_encrypt_fd(in_fd, out_fd, file_entry, flags=0,
+                              digest_algorithm='md5'):
+            out_fd.write(b"half written")
+            raise IOError("disk is full")
+        sync.crypto = Crypto('password')
+        sync.crypto.encrypt_fd = broken_encrypt_fd
+        self.assertRaises(IOError, sync.sync_folder)
+        with open(encrypted_path, 'rb') as f:
+            plain_fd = BytesIO()
+            self.crypto.decrypt_fd(f, plain_fd)
+        self.assertEqual(plain_fd.getvalue(), b"hello world")
+        sync.crypto = self.crypto
+        tmp_folder = os.path.join(self.encrypted_folder, "_syncrypto", "tmp")
+        prepare_filetree(tmp_folder, '''
+            %s/crashed.syncrypto-tmp:half written
+            other/stale.syncrypto-tmp:being written by another client
+        ''' % sync._snapshot_tree_name)
+        sync.sync_folder()
+        self.assertTrue(os.path.exists(
+            os.path.join(tmp_folder, "other", "stale.syncrypto-tmp")))
+        for root in (self.plain_folder, self.encrypted_folder):
+            for dirpath, dirnames, filenames in os.walk(root):
+                self.assertEqual([name for name in filenames
+                                  if name.endswith(".syncrypto-tmp") and
+                                  name != "stale.syncrypto-tmp"], [])
+
+    def test_checkpoint(self):
+        prepare_filetree(self.plain_folder, "\n".join(
+            ["many/%d:%d" % (i, i) for i in range(10)]))
+        self.assertRaises(ValueError, Syncrypto, self.crypto,
+                          self.encrypted_folder, self.plain_folder,
+                          checkpoint_files=0)
+        self.assertRaises(ValueError, Syncrypto, self.crypto,
+                          self.encrypted_folder, self.plain_folder,
+                          checkpoint_size=-1)
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder,
+                         checkpoint_files=3)
+        count = len(sync.sync_folder(dry_run=True))
+        encrypt_content = sync._encrypt_content
+        encrypted = []
+
+        def crash(*args):
+            if len(encrypted) == 5:
+                raise MemoryError()
+            encrypted.append(args[0].pathname)
+            return encrypt_content(*args)
+        sync._encrypt_content = crash
+        self.assertRaises(MemoryError, sync.sync_folder)
+        # checkpoints were made after the third and the sixth pathname
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder,
+                         fast_scan=True)
+        plan = sync.sync_folder(dry_run=True)
+        self.assertEqual(len(plan), count - 6)
+        self.assertEqual(set(item.action for item in plan), set(["encrypt"]))
+        salts = dict((pathname, sync.encrypted_tree.get(pathname).salt)
+                     for pathname in encrypted[1:3])
+
+        def assert_snapshot_salts():
+            sync._load_snapshot_tree()
+            for pathname, salt in salts.items():
+                self.assertTrue(salt is not None)
+                self.assertEqual(sync.snapshot_tree.get(pathname).salt, salt)
+            sync._close_snapshot_tree()
+        assert_snapshot_salts()
+
+        def interrupt(*args):
+            os.kill(os.getpid(), signal.SIGINT)
+            return encrypt_content(*args)
+        encrypt_content = sync._encrypt_content
+        sync._encrypt_content = interrupt
+        self.assertRaises(SyncInterrupted, sync.sync_folder)
+        self.assertEqual(signal.getsignal(signal.SIGINT),
+                         signal.default_int_handler)
+        assert_snapshot_salts()
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder)
+        self.assertEqual(len(sync.sync_folder(dry_run=True)), count - 7)
+        sync.sync_folder()
+        self.assertEqual(len(sync.sync_folder(dry_run=True)), 0)
+        for pathname, salt in salts.items():
+            self.assertEqual(sync.encrypted_tree.get(pathname).salt, salt)
+        sync2 = Syncrypto(self.crypto, self.encrypted_folder,
+                          self.plain_folder_check)
+        sync2.sync_folder()
+        directory_cmp = dircmp(os.path.join(self.plain_folder, "many"),
+                               os.path.join(self.plain_folder_check, "many"))
+        self.assertEqual(directory_cmp.left_only, [])
+        self.assertEqual(directory_cmp.diff_files, [])
+
+    def test_rename(self):
+        prepare_filetree(self.plain_folder, '''
+            big/a:%s
+            big/b:b
+        ''' % ("a" * 20000))
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder)
+        sync.sync_folder()
+        sync2 = Syncrypto(self.crypto, self.encrypted_folder,
+                          self.plain_folder_check)
+        sync2.sync_folder()
+        salts = dict((pathname, sync.encrypted_tree.get(pathname).salt)
+                     for pathname in ("big/a", "dir2/file2"))
+        os.rename(os.path.join(self.plain_folder, "big"),
+                  os.path.join(self.plain_folder, "renamed"))
+        os.rename(os.path.join(self.plain_folder, "dir2", "file2"),
+                  os.path.join(self.plain_folder, "not_empty_dir", "file2"))
+        prepare_filetree(self.plain_folder, '''
+            renamed/b:changed
+        ''')
+        plan = sync.sync_folder(dry_run=True)
+        self.assertEqual([(item.action, item.old_pathname, item.pathname)
+                          for item in plan],
+                         [("rename encrypted", "dir2/file2",
+                           "not_empty_dir/file2"),
+                          ("rename encrypted", "big", "renamed"),
+                          ("encrypt", None, "renamed/b")])
+        self.assertTrue("rename encrypted big -> renamed" in str(plan))
+        self.assertTrue(sync.encrypted_tree.has("big/a"))
+        sync.sync_folder()
+        self.assertFalse(sync.encrypted_tree.has("big"))
+        for pathname, old_pathname in (("renamed/a", "big/a"),
+                                       ("not_empty_dir/file2", "dir2/file2")):
+            encrypted_file = sync.encrypted_tree.get(pathname)
+            self.assertEqual(encrypted_file.salt, salts[old_pathname])
+            self.assertTrue(os.path.exists(
+                encrypted_file.fs_path(self.encrypted_folder)))
+        self.assertTrue(
+            sync.encrypted_tree.get("not_empty_dir/file2").fs_pathname.
+            startswith(sync.encrypted_tree.get("not_empty_dir").fs_pathname +
+                       '/'))
+        self.assertEqual(len(sync.sync_folder(dry_run=True)), 0)
+
+        plan = sync2.sync_folder(dry_run=True)
+        self.assertEqual([(item.action, item.old_pathname, item.pathname)
+                          for item in plan],
+                         [("rename plain", "dir2/file2",
+                           "not_empty_dir/file2"),
+                          ("rename plain", "big", "renamed"),
+                          ("decrypt", None, "renamed/b")])
+        sync2.sync_folder()
+        for pathname in ("renamed/a", "renamed/b", "not_empty_dir/file2"):
+            with open(os.path.join(self.plain_folder, pathname), 'rb') as f:
+                content = f.read()
+            with open(os.path.join(self.plain_folder_check, pathname),
+                      'rb') as f:
+                self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.plain_folder_check, "big")))
+        self.assertEqual(len(sync2.sync_folder(dry_run=True)), 0)
+
+    def test_rename_keeps_fs_pathname(self):
+        # the encrypted file of 92 is 92, the start of the digest of its name
+        prepare_filetree(self.plain_folder, '''
+            92:content
+        ''')
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder)
+        sync.sync_folder()
+        self.assertEqual(sync.encrypted_tree.get("92").fs_pathname, "92")
+        os.rename(os.path.join(self.plain_folder, "92"),
+                  os.path.join(self.plain_folder, "renamed"))
+        sync.sync_folder()
+        encrypted_file = sync.encrypted_tree.get("renamed")
+        self.assertEqual(encrypted_file.fs_pathname, "92")
+        self.assertTrue(os.path.exists(
+            encrypted_file.fs_path(self.encrypted_folder)))
+        sync2 = Syncrypto(self.crypto, self.encrypted_folder,
+                          self.plain_folder_check)
+        sync2.sync_folder()
+        with open(os.path.join(self.plain_folder_check, "renamed"),
+                  'rb') as f:
+            self.assertEqual(f.read(), b"content")
+
+    def test_jobs(self):
+        prepare_filetree(self.plain_folder, "\n".join(
+            ["many/%d:%d" % (i, i) for i in range(50)]))
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder,
+                         jobs=4)
+        sync.sync_folder()
+        self.assertEqual(len(sync.encrypted_tree.names("many")), 50)
+        for i in range(50):
+            encrypted_file = sync.encrypted_tree.get("many/%d" % i)
+            self.assertTrue(os.path.exists(
+                encrypted_file.fs_path(self.encrypted_folder)))
+            self.assertIsNotNone(encrypted_file.salt)
+        self.assertRaises(ValueError, Syncrypto, self.crypto,
+                          self.encrypted_folder, self.plain_folder, jobs=0)
+        sync2 = Syncrypto(self.crypto, self.encrypted_folder,
+                          self.plain_folder_check, jobs=4)
+        sync2.sync_folder()
+        directory_cmp = dircmp(os.path.join(self.plain_folder, "many"),
+                               os.path.join(self.plain_folder_check, "many"))
+        self.assertEqual(directory_cmp.left_only, [])
+        self.assertEqual(directory_cmp.diff_files, [])
+
+    def test_fan_out(self):
+        prepare_filetree(self.plain_folder, '''
+            many/a:a
+            many/b:b
+            many/c:c
+            many/d/e:e
+        ''')
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder,
+                         fan_out=2)
+        sync.sync_folder()
+        bucketed = [f.pathname for f in sync.encrypted_tree.files()
+                    if f.pathname.startswith('many/') and not f.isdir and
+                    f.fs_pathname.split('/')[-2].startswith('_')]
+        self.assertTrue(len(bucketed) > 0)
+        self.assertTrue("many/d/e" not in bucketed)
+        for pathname in bucketed:
+            self.assertTrue(os.path.exists(
+                sync.encrypted_tree.get(pathname).fs_path(
+                    self.encrypted_folder)))
+        sync2 = Syncrypto(self.crypto, self.encrypted_folder,
+                          self.plain_folder_check)
+        sync2.sync_folder()
+        directory_cmp = dircmp(os.path.join(self.plain_folder, "many"),
+                               os.path.join(self.plain_folder_check, "many"))
+        self.assertEqual(directory_cmp.left_only, [])
+        self.assertEqual(directory_cmp.right_only, [])
+        os.remove(os.path.join(self.plain_folder_check, bucketed[0]))
+        sync2.sync_folder()
+        sync.sync_folder()
+        self.assertFalse(os.path.exists(
+            os.path.join(self.plain_folder, bucketed[0])))
+        self.assertRaises(ValueError, Syncrypto, self.crypto,
+                          self.encrypted_folder, self.plain_folder, fan_out=0)
+
+    def test_fingerprint_size(self):
+        path = os.path.join(self.plain_folder, "large")
+        with open(path, "wb") as f:
+            f.write(b"a" * 100000)
+        sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder,
+                         fingerprint_size=1000)
+        sync.sync_folder()
+        self.assertIsNotNone(sync.encrypted_tree.get("large").fingerprint)
+        encrypted_path = sync.encrypted_tree.get("large").fs_path(
+            self.encrypted_folder)
+        with open(encrypted_path, "rb") as f:
+            encrypted_content = f.read()
+        mtime = os.stat(path).st_mtime
+        with open(path, "r+b") as f:
+            f.write(b"b")
+        os.utime(path, (mtime, mtime))
+        sync.sync_folder()
+        with open(encrypted_path, "rb") as f:
+            self.assertNotEqual(f.read(), encrypted_content)
+
     def test_change_password(self):
         sync = Syncrypto(self.crypto, self.encrypted_folder, self.plain_folder,
                          self.encrypted_tree, self.plain_tree,